@@ -17,7 +17,7 @@ setuptools.setup(
         "Bug Tracker": "https://github.com/ni1o1/pybdshadow/issues",
     },
     install_requires=[
-        "numpy", "pandas", "shapely", "geopandas", "matplotlib","suncalc","keplergl","transbigdata","mapbox_vector_tile","vt2geojson","requests","tqdm","retrying"
+        "numpy", "pandas", "shapely>=2.1", "geopandas>=1.0", "matplotlib","suncalc","keplergl","transbigdata","mapbox_vector_tile","vt2geojson","requests","tqdm","retrying"
     ],
     classifiers=[
         "Operating System :: OS Independent",
@@ -26,10 +26,11 @@ setuptools.setup(
         "Topic :: Software Development :: Libraries :: Python Modules",
         "License :: OSI Approved :: BSD License",
         "Programming Language :: Python",
-        "Programming Language :: Python :: 3.8",
-        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
+        "Programming Language :: Python :: 3.12",
     ],
     package_dir={'pybdshadow': 'src/pybdshadow'},
     packages=['pybdshadow'],
-    python_requires=">=3.8",
+    python_requires=">=3.10",
 )
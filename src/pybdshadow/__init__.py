@@ -46,10 +46,17 @@ from .get_buildings import (
 )
 from .pybdshadow import (
     bdshadow_sunlight,
-    bdshadow_pointlight
+    bdshadow_sunlight_stats,
+    bdshadow_pointlight,
+    bdshadow_pointlights
 )
 from .preprocess import (
-    bd_preprocess
+    bd_preprocess,
+    bd_simplify,
+    bd_dissolve,
+    prepare_buildings,
+    PreparedBuildings,
+    bin_heights
 )
 from .visualization import (
     show_bdshadow,
@@ -58,22 +65,41 @@ from .visualization import (
 from .analysis import (
     cal_sunshine,
     cal_sunshadows,
+    iter_sunshadows,
     cal_shadowcoverage,
+    cal_shadowcoverage_raster,
+    raster_to_grids,
     get_timetable
 )
+from .cache import (
+    ShadowCache,
+    buildings_fingerprint
+)
 
 from .utils import (
     extrude_poly
 )
 
 __all__ = ['bdshadow_sunlight',
+           'bdshadow_sunlight_stats',
            'bdshadow_pointlight',
+           'bdshadow_pointlights',
            'bd_preprocess',
+           'bd_simplify',
+           'bd_dissolve',
+           'prepare_buildings',
+           'PreparedBuildings',
+           'bin_heights',
            'show_bdshadow',
            'cal_sunshine',
            'cal_sunshadows',
+           'iter_sunshadows',
            'cal_shadowcoverage',
+           'cal_shadowcoverage_raster',
+           'raster_to_grids',
            'get_timetable',
+           'ShadowCache',
+           'buildings_fingerprint',
            'get_buildings_by_polygon',
            'get_buildings_by_bounds',
            'cal_sunshine_facade',
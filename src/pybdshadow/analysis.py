@@ -1,13 +1,18 @@
+import numpy as np
 import pandas as pd
+import shapely
+from pyproj import Transformer
 from suncalc import get_times
-from shapely.geometry import MultiPolygon,Polygon
+from shapely.geometry import Polygon
 import transbigdata as tbd
 import geopandas as gpd
 from .pybdshadow import (
     bdshadow_sunlight,
+    get_prepared_sun_positions,
 )
-from .preprocess import bd_preprocess
-from .utils import count_overlapping_features
+from .preprocess import bd_preprocess, prepare_buildings, PreparedBuildings
+from .cache import ShadowCache, buildings_fingerprint
+from .utils import count_overlapping_features, get_projection, groupby_union, is_metric_crs, rasterize_polygons
 
 def get_timetable(lon, lat, dates=['2022-01-01'], precision=3600, padding=1800):
     # generate timetable with given interval
@@ -29,13 +34,14 @@ def get_timetable(lon, lat, dates=['2022-01-01'], precision=3600, padding=1800):
     return dates
 
 
-def cal_sunshine(buildings, day='2022-01-01', roof=False, grids=gpd.GeoDataFrame(), accuracy=1, precision=3600, padding=1800):
+def cal_sunshine(buildings, day='2022-01-01', roof=False, grids=gpd.GeoDataFrame(), accuracy=1, precision=3600, padding=1800,
+                 method='vector'):
     '''
     Calculate the sunshine time in given date.
 
     Parameters
     --------------------
-    buildings : GeoDataFrame
+    buildings : GeoDataFrame or PreparedBuildings
         Buildings. coordinate system should be WGS84
     day : str
         the day to calculate the sunshine
@@ -49,6 +55,8 @@ def cal_sunshine(buildings, day='2022-01-01', roof=False, grids=gpd.GeoDataFrame
         padding time before and after sunrise and sunset
     accuracy : number
         size of grids. Produce vector polygons if set as `vector` 
+    method : str
+        Method of the grid analysis, 'vector' or 'raster', see `cal_shadowcoverage`.
 
     Return
     ----------
@@ -58,8 +66,11 @@ def cal_sunshine(buildings, day='2022-01-01', roof=False, grids=gpd.GeoDataFrame
     '''
 
 
+    prepared = prepare_buildings(buildings)
+    buildings = prepared.source
+
     # calculate day time duration
-    lon, lat = buildings['geometry'].iloc[0].bounds[:2]
+    lon, lat = _reference_lonlat(buildings)
     date = pd.to_datetime(day+' 12:45:33.959797119')
     times = get_times(date, lon, lat)
     date_sunrise = times['sunrise']
@@ -70,16 +81,19 @@ def cal_sunshine(buildings, day='2022-01-01', roof=False, grids=gpd.GeoDataFrame
         timestamp_sunset.iloc[0]-timestamp_sunrise.iloc[0])/(1000000000*3600)
 
     # Generate shadow every time interval
-    shadows = cal_sunshadows(
-        buildings, dates=[day], precision=precision, padding=padding)
+    stream = iter_sunshadows(prepared, dates=[day], precision=precision, padding=padding)
     if accuracy == 'vector':
+        # 逐个时刻合并阴影，只保留合并后的结果
         if roof:
-            shadows = shadows[shadows['type'] == 'roof']
+            shadows = []
+            for _, shadow in stream:
+                shadow = shadow[shadow['type'] == 'roof']
+                if len(shadow) > 0:
+                    shadows.append(groupby_union(bd_preprocess(shadow), ['date', 'type', 'height']))
             if len(shadows)>0:
-                shadows = bd_preprocess(shadows)
-                shadows = shadows.groupby(['date', 'type','height'])['geometry'].apply(
-                    lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-                shadows = bd_preprocess(shadows)
+                shadows = bd_preprocess(pd.concat(shadows))
+            else:
+                shadows = gpd.GeoDataFrame()
 
             # 额外：增加屋顶面
             shadows = pd.concat([shadows, buildings])
@@ -87,12 +101,9 @@ def cal_sunshine(buildings, day='2022-01-01', roof=False, grids=gpd.GeoDataFrame
             shadows = shadows.groupby('height').apply(count_overlapping_features).reset_index()
             shadows['count'] -= 1
         else:
-            shadows = shadows[shadows['type'] == 'ground']
-
-            shadows = bd_preprocess(shadows)
-            shadows = shadows.groupby(['date', 'type'])['geometry'].apply(
-            lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-            shadows = bd_preprocess(shadows)
+            shadows = [groupby_union(bd_preprocess(shadow[shadow['type'] == 'ground']), ['date', 'type'])
+                       for _, shadow in stream]
+            shadows = bd_preprocess(pd.concat(shadows))
 
             # 额外：增加地面面
             minpos = shadows.bounds[['minx','miny']].min()
@@ -120,20 +131,21 @@ def cal_sunshine(buildings, day='2022-01-01', roof=False, grids=gpd.GeoDataFrame
     else:
         # Grid analysis of shadow cover duration(ground).
         grids = cal_shadowcoverage(
-            shadows, buildings, grids=grids, roof=roof, precision=precision, accuracy=accuracy)
+            stream, prepared, grids=grids, roof=roof, precision=precision, accuracy=accuracy, method=method)
 
         grids['Hour'] = sunlighthour-grids['time']/3600
         return grids
     
 
 def cal_sunshadows(buildings, cityname='somecity', dates=['2022-01-01'], precision=3600, padding=1800,
-                   roof=True, include_building=True, save_shadows=False, printlog=False):
+                   roof=True, include_building=True, save_shadows=False, printlog=False, grid_size=None,
+                   height_bin=None, n_jobs=None, cache=None):
     '''
     Calculate the sunlight shadow in different date with given time precision.
 
     Parameters
     --------------------
-    buildings : GeoDataFrame
+    buildings : GeoDataFrame or PreparedBuildings
         Buildings. coordinate system should be WGS84
     cityname : string
         Cityname. If save_shadows, this function will create `result/cityname` folder to save the shadows
@@ -148,9 +160,21 @@ def cal_sunshadows(buildings, cityname='somecity', dates=['2022-01-01'], precisi
     include_building : bool
         whether the shadow include building outline
     save_shadows : bool
-        whether to save calculated shadows
+        whether to save calculated shadows as GeoJSON in the `result/cityname` folder.
+        Use `cache` to reuse the shadows of previous runs.
     printlog : bool
         whether to print log
+    grid_size : float
+        Precision of the shadow coordinates, e.g. 1e-7 for degrees or 0.01 for meters.
+        The saved files are also written with this precision.
+    height_bin : number
+        Round the building heights to bins of this size(meter), see `bin_heights`.
+    n_jobs : int
+        Number of processes. If given, the timestamps are calculated on a process pool.
+        The prepared buildings are sent once to each process, and the shadows are returned in the order of the timestamps.
+    cache : ShadowCache or str
+        Cache of the shadows, or the folder of a `ShadowCache`. The shadows of the timestamps
+        already in the cache are loaded instead of calculated, and the others are added to it.
 
     Return
     ----------
@@ -160,8 +184,9 @@ def cal_sunshadows(buildings, cityname='somecity', dates=['2022-01-01'], precisi
     if (padding < 1800):
         raise ValueError(
             'Padding time should be over 1800s to avoid sun altitude under 0')  # pragma: no cover
+    prepared = prepare_buildings(buildings, height_bin=height_bin)
     # obtain city location
-    lon, lat = buildings['geometry'].iloc[0].bounds[:2]
+    lon, lat = _reference_lonlat(prepared.source)
     timetable = get_timetable(lon, lat, dates, precision, padding)
     import os
     if save_shadows:
@@ -169,41 +194,164 @@ def cal_sunshadows(buildings, cityname='somecity', dates=['2022-01-01'], precisi
             os.mkdir('result')                       # pragma: no cover
         if not os.path.exists('result/'+cityname):   # pragma: no cover
             os.mkdir('result/'+cityname)             # pragma: no cover
+    options = {'roof': roof, 'include_building': include_building, 'grid_size': grid_size}
+    save_options = {}
+    if grid_size is not None:
+        save_options['COORDINATE_PRECISION'] = max(0, int(np.ceil(-np.log10(grid_size))))
     allshadow = []
-    for i in range(len(timetable)):
-        date = timetable['datetime'].iloc[i]
-        name = timetable['date'].iloc[i]
-        if not os.path.exists('result/'+cityname+'/roof_'+name+'.json'):
-            if printlog:
-                print('Calculating', cityname, ':', name)    # pragma: no cover
-            # Calculate shadows
-            shadows = bdshadow_sunlight(
-                buildings, date, roof=roof, include_building=include_building)
-            shadows['date'] = date
-            roof_shaodws = shadows[shadows['type'] == 'roof']
-            ground_shaodws = shadows[shadows['type'] == 'ground']
-
-            if save_shadows:
-                if len(roof_shaodws) > 0:    # pragma: no cover
-                    roof_shaodws.to_file(    # pragma: no cover
-                        'result/'+cityname+'/roof_'+name+'.json', driver='GeoJSON')  # pragma: no cover
-                if len(ground_shaodws) > 0:  # pragma: no cover
-                    ground_shaodws.to_file(  # pragma: no cover
-                        'result/'+cityname+'/ground_'+name+'.json', driver='GeoJSON')  # pragma: no cover
-            allshadow.append(shadows)
+    for name, (date, shadows) in zip(timetable['date'],
+                                     _iter_timetable(prepared, timetable['datetime'], options, n_jobs, cache)):
+        if printlog:
+            print('Calculating', cityname, ':', name)    # pragma: no cover
+        if save_shadows:
+            roof_shaodws = shadows[shadows['type'] == 'roof']            # pragma: no cover
+            ground_shaodws = shadows[shadows['type'] == 'ground']        # pragma: no cover
+            if len(roof_shaodws) > 0:    # pragma: no cover
+                roof_shaodws.to_file(    # pragma: no cover
+                    'result/'+cityname+'/roof_'+name+'.json', driver='GeoJSON', **save_options)  # pragma: no cover
+            if len(ground_shaodws) > 0:  # pragma: no cover
+                ground_shaodws.to_file(  # pragma: no cover
+                    'result/'+cityname+'/ground_'+name+'.json', driver='GeoJSON', **save_options)  # pragma: no cover
+        allshadow.append(shadows)
     allshadow = pd.concat(allshadow)
     return allshadow
 
 
-def cal_shadowcoverage(shadows_input, buildings, grids=gpd.GeoDataFrame(), roof=True, precision=3600, accuracy=1):
+def iter_sunshadows(buildings, dates=['2022-01-01'], precision=3600, padding=1800, roof=True,
+                    include_building=True, grid_size=None, height_bin=None, n_jobs=None, cache=None):
+    '''
+    Calculate the sunlight shadow in different date with given time precision, one timestamp at a time.
+
+    The same as `cal_sunshadows`, but the shadows of each timestamp are yielded as soon as they
+    are calculated instead of being concatenated, so that only one timestamp is kept in memory.
+    The stream can be given to `cal_shadowcoverage`.
+
+    Parameters
+    --------------------
+    buildings : GeoDataFrame or PreparedBuildings
+        Buildings. coordinate system should be WGS84
+    dates : list
+        List of dates
+    precision : number
+        Time precision(s)
+    padding : number
+        Padding time (second) before and after sunrise and sunset. Should be over 1800s to avoid sun altitude under 0
+    roof : bool
+        whether to calculate roof shadow.
+    include_building : bool
+        whether the shadow include building outline
+    grid_size : float
+        Precision of the shadow coordinates, see `cal_sunshadows`.
+    height_bin : number
+        Round the building heights to bins of this size(meter), see `bin_heights`.
+    n_jobs : int
+        Number of processes. If given, the next timestamps are calculated on a process pool while
+        the current one is consumed, at most two timestamps per process are kept in advance.
+    cache : ShadowCache or str
+        Cache of the shadows, or the folder of a `ShadowCache`. The shadows of the timestamps
+        already in the cache are loaded instead of calculated, and the others are added to it.
+
+    Yields
+    ----------
+    datetime : Timestamp
+        Datetime of the timestamp, in the order of the dates.
+    shadows : GeoDataFrame
+        Building shadows of the timestamp, with a `date` column.
+    '''
+    if (padding < 1800):
+        raise ValueError(
+            'Padding time should be over 1800s to avoid sun altitude under 0')  # pragma: no cover
+    prepared = prepare_buildings(buildings, height_bin=height_bin)
+    lon, lat = _reference_lonlat(prepared.source)
+    timetable = get_timetable(lon, lat, dates, precision, padding)
+    options = {'roof': roof, 'include_building': include_building, 'grid_size': grid_size}
+    yield from _iter_timetable(prepared, timetable['datetime'], options, n_jobs, cache)
+
+
+def _iter_timetable(prepared, datetimes, options, n_jobs=None, cache=None):
+    '''
+    Yield the datetime and the shadows of each timestamp, in order.
+    The timestamps in the cache are loaded when they are reached, the others, and those evicted
+    in the meantime, are calculated and added to the cache.
+    '''
+    datetimes = list(datetimes)
+    keys = [None]*len(datetimes)
+    if cache is not None:
+        if not isinstance(cache, ShadowCache):
+            cache = ShadowCache(cache)
+        fingerprint = buildings_fingerprint(prepared)
+        keys = [cache.key(fingerprint, sunPosition, **options)
+                for sunPosition in get_prepared_sun_positions(prepared, datetimes)]
+    cached = [(key is not None) and (key in cache) for key in keys]
+    calculated = _calculate_timetable(
+        prepared, [date for date, hit in zip(datetimes, cached) if not hit], options, n_jobs)
+    for date, key, hit in zip(datetimes, keys, cached):
+        # 读取时才加载缓存，期间被清除的时刻重新计算
+        shadows = cache.get(key) if hit else None
+        if shadows is not None:
+            shadows['date'] = date
+            yield date, shadows
+            continue
+        if hit:
+            shadows = bdshadow_sunlight(prepared, [date], **options)
+        else:
+            shadows = next(calculated)
+        if cache is not None:
+            cache.put(key, shadows.drop(columns='date'))
+        yield date, shadows
+
+
+def _calculate_timetable(prepared, datetimes, options, n_jobs=None):
+    '''
+    Yield the shadows of each timestamp, in order.
+    With `n_jobs`, at most two timestamps per process are calculated in advance.
+    '''
+    if n_jobs is None:
+        for date in datetimes:
+            yield bdshadow_sunlight(prepared, [date], **options)
+        return
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_sunshadows_worker,
+                             initargs=(prepared,)) as executor:
+        pending = deque()
+        for date in datetimes:
+            pending.append(executor.submit(_sunshadows_task, [date], options))
+            if len(pending) >= 2*n_jobs:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+_worker_buildings = None
+
+
+def _init_sunshadows_worker(prepared):
+    '''
+    Keep the prepared buildings in the worker process of `cal_sunshadows`.
+    '''
+    global _worker_buildings
+    _worker_buildings = prepared
+
+
+def _sunshadows_task(dates, options):
+    '''
+    Calculate the shadows of some timestamps with the prepared buildings of the worker process.
+    '''
+    return bdshadow_sunlight(_worker_buildings, dates, **options)
+
+
+def cal_shadowcoverage(shadows_input, buildings, grids=gpd.GeoDataFrame(), roof=True, precision=3600, accuracy=1,
+                       method='vector'):
     '''
     Calculate the sunlight shadow coverage time for given area.
 
     Parameters
     --------------------
-    shadows_input : GeoDataFrame
-        All building shadows calculated
-    buildings : GeoDataFrame
+    shadows_input : GeoDataFrame or iterable
+        All building shadows calculated, or the stream of `(datetime, shadows)` yielded by `iter_sunshadows`,
+        which is consumed one timestamp at a time.
+    buildings : GeoDataFrame or PreparedBuildings
         Buildings. coordinate system should be WGS84
     grids : GeoDataFrame
         grids generated by TransBigData in study area
@@ -213,6 +361,11 @@ def cal_shadowcoverage(shadows_input, buildings, grids=gpd.GeoDataFrame(), roof=
         time precision(s), which is for calculation of coverage time
     accuracy : number
         size of grids.
+    method : str
+        - 'vector' : a grid is covered when it intersects the shadows.
+        - 'raster' : a grid is covered when its center is in the shadows, calculated by
+          `cal_shadowcoverage_raster` without grid polygons and converted by `raster_to_grids`.
+          Much faster for small grids, `grids` can not be given and the building columns are not joined.
 
     Return
     --------------------
@@ -220,32 +373,176 @@ def cal_shadowcoverage(shadows_input, buildings, grids=gpd.GeoDataFrame(), roof=
         grids generated by TransBigData in study area, each grids have a `time` column store the shadow coverage time
 
     '''
-    shadows = bd_preprocess(shadows_input)
+    if method == 'raster':
+        if len(grids) > 0:
+            raise ValueError("grids can not be given with the raster method")
+        shadow_time, transform = cal_shadowcoverage_raster(
+            shadows_input, buildings, roof=roof, precision=precision, accuracy=accuracy)
+        if isinstance(buildings, PreparedBuildings):
+            buildings = buildings.source
+        crs = buildings.crs if is_metric_crs(buildings.crs) else None
+        return raster_to_grids(shadow_time, transform, precision=precision, crs=crs)
+    elif method != 'vector':
+        raise ValueError("method should be 'vector' or 'raster'")
+    if isinstance(buildings, PreparedBuildings):
+        buildings = buildings.source
+    if isinstance(shadows_input, pd.DataFrame):
+        shadows_input = shadows_input.groupby('date')
+    crs = buildings.crs
 
     # study area
     bounds = buildings.unary_union.bounds
+    metric = is_metric_crs(crs)
     if len(grids) == 0:
-        grids, params = tbd.area_to_grid(bounds, accuracy)
+        if metric:
+            grids = _metric_grids(bounds, accuracy*_crs_scale(buildings))
+        else:
+            grids, params = tbd.area_to_grid(bounds, accuracy)
 
+    buildings = buildings.set_crs(None, allow_override=True)
     if roof:
-        ground_shadows = shadows[shadows['type'] == 'roof'].groupby(['date'])['geometry'].apply(
-            lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-
-        buildings.crs = None
         grids = gpd.sjoin(grids, buildings)
     else:
-        ground_shadows = shadows[shadows['type'] == 'ground'].groupby(['date'])['geometry'].apply(
-            lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-
-        buildings.crs = None
         grids = gpd.sjoin(grids, buildings, how='left')
         grids = grids[grids['index_right'].isnull()]
+    grids = grids.reset_index(drop=True)
 
-    gridcount = gpd.sjoin(grids[['LONCOL', 'LATCOL', 'geometry']], ground_shadows[['geometry', 'date']]).\
-        drop_duplicates(subset=['LONCOL', 'LATCOL', 'date']).groupby(['LONCOL', 'LATCOL'])['geometry'].\
-        count().rename('count').reset_index()
-    grids = pd.merge(grids, gridcount, how='left')
+    # 逐个时刻累计被阴影覆盖的次数
+    shadow_type = 'roof' if roof else 'ground'
+    tree = shapely.STRtree(np.asarray(grids['geometry']))
+    count = np.zeros(len(grids), dtype=int)
+    for _, shadows in shadows_input:
+        shadows = shadows[shadows['type'] == shadow_type]
+        if len(shadows) == 0:
+            continue
+        shadows = bd_preprocess(shadows)
+        covered = tree.query(shapely.union_all(np.asarray(shadows['geometry'])), predicate='intersects')
+        count[covered] += 1
+    grids['count'] = np.where(count > 0, count, np.nan)
     grids['time'] = grids['count'].fillna(0)*precision
+    if metric:
+        grids = grids.set_crs(crs, allow_override=True)
+
+    return grids
+
+
+def cal_shadowcoverage_raster(shadows_input, buildings, roof=True, precision=3600, accuracy=1):
+    '''
+    Calculate the sunlight shadow coverage time for given area on a raster.
+
+    Instead of building one polygon per grid, the shadows of each timestamp are burnt into
+    a counter array by scanline rasterization(see `rasterize_polygons`), a cell is covered when its
+    center is in the shadows. The cells are aligned with the grids of `cal_shadowcoverage`.
+
+    Parameters
+    --------------------
+    shadows_input : GeoDataFrame or iterable
+        All building shadows calculated, or the stream of `(datetime, shadows)` yielded by `iter_sunshadows`.
+    buildings : GeoDataFrame or PreparedBuildings
+        Buildings. coordinate system should be WGS84, or a projected coordinate system in meters.
+    roof : bool
+        If true roof shadow, false then ground shadow
+    precision : number
+        time precision(s), which is for calculation of coverage time
+    accuracy : number
+        size of grids(meter).
+
+    Return
+    --------------------
+    shadow_time : numpy.ndarray
+        Shadow coverage time(s) of each cell, north up. The cells outside the roofs(`roof=True`)
+        or inside the buildings(`roof=False`) are NaN.
+    transform : tuple
+        GDAL geotransform of the raster, `(x_min, cell width, 0, y_max, 0, -cell height)`,
+        in the coordinate system of the buildings.
+    '''
+    if isinstance(buildings, PreparedBuildings):
+        buildings = buildings.source
+    if isinstance(shadows_input, pd.DataFrame):
+        shadows_input = shadows_input.groupby('date')
+
+    # 与cal_shadowcoverage的栅格对齐，第0列、第0行的中心位于建筑范围的左下角
+    minx, miny, maxx, maxy = shapely.total_bounds(np.asarray(buildings['geometry']))
+    if is_metric_crs(buildings.crs):
+        dx = dy = accuracy*_crs_scale(buildings)
+    else:
+        dx = accuracy*360/(2*np.pi*6371004*np.cos((miny+maxy)*np.pi/360))
+        dy = accuracy*360/(2*np.pi*6371004)
+    shape = (int(np.ceil((maxy-miny)/dy))+1, int(np.ceil((maxx-minx)/dx))+1)
+    transform = (minx-0.5*dx, dx, 0, miny+(shape[0]-0.5)*dy, 0, -dy)
+
+    in_building = rasterize_polygons(np.asarray(buildings['geometry']), transform, shape)
+    shadow_type = 'roof' if roof else 'ground'
+    count = np.zeros(shape, dtype=int)
+    for _, shadows in shadows_input:
+        shadows = shadows[shadows['type'] == shadow_type]
+        count += rasterize_polygons(np.asarray(shadows['geometry']), transform, shape)
+    study = in_building if roof else ~in_building
+    shadow_time = np.where(study, count*float(precision), np.nan)
+    return shadow_time, transform
 
+
+def raster_to_grids(shadow_time, transform, precision=3600, crs=None):
+    '''
+    Convert the raster of `cal_shadowcoverage_raster` to grids, as returned by `cal_shadowcoverage`.
+
+    Parameters
+    --------------------
+    shadow_time : numpy.ndarray
+        Shadow coverage time(s) of each cell, NaN cells are left out.
+    transform : tuple
+        GDAL geotransform of the raster.
+    precision : number
+        time precision(s), to obtain the `count` column.
+    crs : optional
+        Coordinate system of the grids.
+
+    Return
+    --------------------
+    grids : GeoDataFrame
+        Grids with `LONCOL`, `LATCOL`, `geometry`, `count`(NaN if never covered) and `time` columns
+    '''
+    x0, dx, _, y0, _, dy = transform
+    # 自下而上排列，与网格编号一致
+    rows, cols = np.nonzero(~np.isnan(shadow_time[::-1]))
+    rows_from_top = shadow_time.shape[0]-1-rows
+    x, y = x0+cols*dx, y0+(rows_from_top+1)*dy
+    time = shadow_time[rows_from_top, cols]
+    grids = gpd.GeoDataFrame({'LONCOL': cols, 'LATCOL': rows},
+                             geometry=shapely.box(x, y, x+dx, y-dy), crs=crs)
+    grids['count'] = np.where(time > 0, time/precision, np.nan)
+    grids['time'] = time
+    return grids
+
+
+def _reference_lonlat(buildings):
+    '''
+    Longitude and latitude of the first building, used to obtain the sunrise and sunset time.
+    '''
+    x, y = buildings['geometry'].iloc[0].bounds[:2]
+    if is_metric_crs(buildings.crs):
+        x, y = Transformer.from_crs(buildings.crs, 'EPSG:4326', always_xy=True).transform(x, y)
+    return x, y
+
+
+def _crs_scale(buildings):
+    '''
+    Scale factor of the projected coordinate system of the buildings at their center, see `MetricProjection`.
+    '''
+    return get_projection(buildings['geometry'], buildings.crs).scale
+
+
+def _metric_grids(bounds, accuracy):
+    '''
+    Square grids of `accuracy` units of the coordinate system covering the bounds, for the buildings in a projected coordinate system.
+    The columns are the same as the grids generated by TransBigData.
+    '''
+    minx, miny, maxx, maxy = bounds
+    loncol, latcol = np.meshgrid(np.arange(int(np.ceil((maxx-minx)/accuracy))+1),
+                                 np.arange(int(np.ceil((maxy-miny)/accuracy))+1))
+    loncol, latcol = loncol.ravel(), latcol.ravel()
+    x, y = minx+(loncol-0.5)*accuracy, miny+(latcol-0.5)*accuracy
+    grids = gpd.GeoDataFrame({'LONCOL': loncol, 'LATCOL': latcol},
+                             geometry=shapely.box(x, y, x+accuracy, y+accuracy))
     return grids
 
@@ -0,0 +1,185 @@
+"""
+BSD 3-Clause License
+
+Copyright (c) 2022, Qing Yu
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+
+def buildings_fingerprint(prepared):
+    '''
+    Fingerprint of the prepared buildings, from their footprints, heights, ids, ground and coordinate system,
+    and the outlines of all the input buildings that are subtracted with `include_building=False`.
+
+    Parameters
+    ----------
+    prepared : PreparedBuildings
+        Prepared buildings.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal sha256 digest.
+    '''
+    digest = hashlib.sha256()
+    digest.update(str(prepared.crs).encode())
+    digest.update(np.asarray([prepared.ground, len(prepared), len(prepared.obstacles)], dtype=float).tobytes())
+    digest.update(np.asarray(prepared.heights, dtype=float).tobytes())
+    digest.update(pd.util.hash_array(np.asarray(prepared.building_id)).tobytes())
+    for wkb in shapely.to_wkb(prepared.footprints):
+        digest.update(wkb)
+    # 低于地面的建筑不产生阴影，但仍从阴影中扣除
+    for wkb in shapely.to_wkb(prepared.obstacles):
+        digest.update(wkb)
+    return digest.hexdigest()
+
+
+class ShadowCache:
+    '''
+    Content-addressed on-disk cache of the sunlight shadows.
+
+    Each entry holds the shadows of one timestamp as a GeoParquet file, named by the hash of
+    the building fingerprint(see `buildings_fingerprint`), the sun position and the shadow options.
+    The shadows are thus reused by any run with the same buildings and sun position,
+    whatever the city name or the date. When the files exceed `max_size`, the least recently
+    used ones are removed. Requires pyarrow.
+
+    Parameters
+    ----------
+    path : str
+        Folder of the cache files, created if not existing.
+    max_size : int
+        Maximum total size of the cache files(bytes). If None, the cache is not bounded.
+    '''
+
+    def __init__(self, path='result/cache', max_size=2**30):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError(
+                "Please install pyarrow, run "
+                "the following code in cmd: pip install pyarrow")
+        self.path = path
+        self.max_size = max_size
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, fingerprint, sunPosition, roof, include_building, grid_size=None):
+        '''
+        Cache key of the shadows of the buildings with the given fingerprint at one sun position.
+
+        Parameters
+        ----------
+        fingerprint : str
+            Fingerprint of the prepared buildings, see `buildings_fingerprint`.
+        sunPosition : array-like
+            Sun azimuth and altitude in radians.
+        roof, include_building, grid_size :
+            Options of `bdshadow_sunlight`.
+
+        Returns
+        -------
+        key : str
+            Hexadecimal sha256 digest.
+        '''
+        from . import __version__
+        digest = hashlib.sha256()
+        digest.update(fingerprint.encode())
+        digest.update(np.asarray(sunPosition, dtype=float).tobytes())
+        digest.update(repr((bool(roof), bool(include_building), grid_size, __version__)).encode())
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key+'.parquet')
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def get(self, key):
+        '''
+        Load the shadows of the key, or None if they are not in the cache.
+        '''
+        file = self._file(key)
+        try:
+            shadows = gpd.read_parquet(file)
+            # 记录最近使用时间
+            os.utime(file)
+        except FileNotFoundError:
+            return None
+        return shadows
+
+    def put(self, key, shadows):
+        '''
+        Save the shadows of the key, then remove the least recently used files beyond `max_size`.
+        '''
+        file = self._file(key)
+        tmp = file+'.%d.tmp' % os.getpid()
+        shadows.to_parquet(tmp)
+        os.replace(tmp, file)
+        self.evict(keep=file)
+
+    def evict(self, keep=None):
+        '''
+        Remove the least recently used files until the cache fits in `max_size`.
+        '''
+        if self.max_size is None:
+            return
+        files = [entry for entry in os.scandir(self.path)
+                 if entry.is_file() and entry.name.endswith('.parquet')]
+        stats = [entry.stat() for entry in files]
+        total = sum(stat.st_size for stat in stats)
+        for i in np.argsort([stat.st_mtime_ns for stat in stats], kind='stable'):
+            if total <= self.max_size:
+                break
+            if files[i].path == keep:
+                continue
+            try:
+                os.remove(files[i].path)
+            except FileNotFoundError:   # pragma: no cover
+                pass
+            total -= stats[i].st_size
+
+    def size(self):
+        '''
+        Total size of the cache files(bytes).
+        '''
+        return sum(entry.stat().st_size for entry in os.scandir(self.path)
+                   if entry.is_file() and entry.name.endswith('.parquet'))
+
+    def clear(self):
+        '''
+        Remove all the cache files.
+        '''
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith('.parquet'):
+                os.remove(entry.path)
@@ -30,11 +30,20 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import shapely
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import  MultiPolygon
+from .utils import (
+    bd_to_walls,
+    connected_components,
+    get_projection,
+    is_convex,
+    simplify_footprints,
+    union_by_group,
+    wall_normals,
+)
 
-def bd_preprocess(buildings, height=''):
+def bd_preprocess(buildings, height='', n_jobs=None, chunksize=100000):
     '''
     Preprocess building data, so that we can perform shadow calculation.
     Remove empty polygons and convert multipolygons into polygons.
@@ -45,90 +54,406 @@ def bd_preprocess(buildings, height=''):
         Buildings.
     height : string
         Column name of building height(meter).
+    n_jobs : int
+        Number of processes. If given, the buildings are processed in chunks on a process pool.
+    chunksize : int
+        Number of buildings in each chunk when `n_jobs` is given.
 
     Return
     ----------
     allbds : GeoDataFrame
-        Polygon buildings
+        Polygon buildings, in the coordinate system of the input(WGS84 if the input has none).
+        The parts of the multipolygons come first, followed by the polygons.
     '''
-    buildings['geometry'] = buildings.buffer(0)
-    buildings = buildings[buildings.is_valid].copy()
-    if height!='':
-        # 建筑高度筛选
-        buildings[height] = pd.to_numeric(buildings[height], errors='coerce')
-        buildings = buildings[buildings[height]>0].copy()
-
-    polygon_buildings = buildings[buildings['geometry'].apply(
-        lambda r:type(r) == shapely.geometry.polygon.Polygon)]
-    multipolygon_buildings = buildings[buildings['geometry'].apply(
-        lambda r:type(r) == shapely.geometry.multipolygon.MultiPolygon)]
-    allbds = []
-    for j in range(len(multipolygon_buildings)):
-        r = multipolygon_buildings.iloc[j]
-        singlebd = gpd.GeoDataFrame()
-        singlebd['geometry'] = list(r['geometry'].geoms)
-        for i in r.index:
-            if i != 'geometry':
-                singlebd[i] = r[i]
-        allbds.append(singlebd)
-    allbds.append(polygon_buildings)
-    allbds = pd.concat(allbds)
+    if (n_jobs is None) or (len(buildings) <= chunksize):
+        parts = [_preprocess_chunk(buildings, height)]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        chunks = [buildings.iloc[start:start+chunksize]
+                  for start in range(0, len(buildings), chunksize)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            parts = list(executor.map(_preprocess_chunk, chunks, [height]*len(chunks)))
+    multipolygon_parts = [part[0] for part in parts if part[0] is not None]
+    allbds = pd.concat(multipolygon_parts+[part[1] for part in parts])
     if len(allbds) > 0:
         allbds = gpd.GeoDataFrame(allbds)
         allbds['building_id'] = range(len(allbds))
-        allbds['geometry'] = allbds.buffer(0)
+        allbds['geometry'] = shapely.buffer(np.asarray(allbds['geometry']), 0)
+    else:
+        allbds = gpd.GeoDataFrame(geometry=[])
+    if buildings.crs is not None:
+        allbds.crs = buildings.crs
     else:
-        allbds = gpd.GeoDataFrame()
-    allbds.crs = {'init': 'epsg:4326'}
+        allbds.crs = {'init': 'epsg:4326'}
     return allbds
 
+
+def _preprocess_chunk(buildings, height):
+    '''
+    Repair the geometries, filter the heights and explode the multipolygons of a chunk of buildings.
+
+    Returns the parts of the multipolygons(None if there is no multipolygon) and the polygons.
+    '''
+    geometry = shapely.buffer(np.asarray(buildings['geometry']), 0)
+    buildings = buildings.copy()
+    buildings['geometry'] = geometry
+    buildings = buildings[shapely.is_valid(geometry)].copy()
+    if height!='':
+        # 建筑高度筛选
+        buildings[height] = pd.to_numeric(buildings[height], errors='coerce')
+        buildings = buildings[buildings[height]>0].copy()
+
+    type_id = shapely.get_type_id(np.asarray(buildings['geometry']))
+    polygon_buildings = buildings[type_id == 3]
+    multipolygon_buildings = buildings[type_id == 6]
+    if len(multipolygon_buildings) == 0:
+        return None, polygon_buildings
+    # 多部件建筑拆分，每个部件复制原有属性
+    parts, index = shapely.get_parts(
+        np.asarray(multipolygon_buildings['geometry']), return_index=True)
+    columns = [column for column in buildings.columns if column != 'geometry']
+    singlebds = pd.DataFrame(multipolygon_buildings[columns].iloc[index])
+    singlebds.index = pd.Series(index).groupby(index).cumcount().values
+    singlebds.insert(0, 'geometry', parts)
+    singlebds = gpd.GeoDataFrame(singlebds, geometry='geometry', crs=buildings.crs)
+    return singlebds, polygon_buildings
+
+
+def bd_simplify(buildings, tolerance=0.5, return_report=False):
+    '''
+    Simplify the building footprints to reduce the number of walls.
+
+    The vertices within `tolerance` of the simplified outline are removed. The simplified footprints
+    stay valid and always contain the original ones, so the shadows are never smaller than before.
+    Footprints that cannot be simplified under these conditions are kept unchanged.
+
+    Parameters
+    --------------
+    buildings : GeoDataFrame
+        Buildings, preprocessed by `bd_preprocess`. coordinate system should be WGS84, or a projected coordinate system in meters.
+    tolerance : number
+        Simplification tolerance(meter).
+    return_report : bool
+        Whether to return the number of walls removed.
+
+    Return
+    ----------
+    buildings : GeoDataFrame
+        Simplified buildings.
+    report : dict
+        Only if `return_report`. The number of walls before and after, the walls removed and the buildings kept unchanged.
+    '''
+    buildings = buildings.copy()
+    projection = get_projection(buildings['geometry'], buildings.crs)
+    footprints = projection.forward_geometry(buildings['geometry'])
+    simplified, fallback = simplify_footprints(footprints, tolerance)
+    buildings['geometry'] = projection.inverse_geometry(simplified)
+    if not return_report:
+        return buildings
+    walls_before = len(bd_to_walls(footprints)[0])
+    walls_after = len(bd_to_walls(simplified)[0])
+    report = {'walls_before': walls_before,
+              'walls_after': walls_after,
+              'walls_removed': walls_before-walls_after,
+              'unchanged': int(fallback.sum())}
+    return buildings, report
+
+
+def bd_dissolve(buildings, height='height', height_bin=None):
+    '''
+    Merge the touching buildings of the same height, so that their shared walls are removed.
+
+    Buildings sharing an edge or overlapping are merged if they have the same height,
+    or the same binned height if `height_bin` is given. Buildings only touching at a corner are kept apart.
+
+    Parameters
+    --------------
+    buildings : GeoDataFrame
+        Buildings, preprocessed by `bd_preprocess`.
+    height : string
+        Column name of building height(meter).
+    height_bin : number or None
+        Size of the height bins(meter), see `bin_heights`. If None, only the equal heights are merged.
+
+    Return
+    ----------
+    dissolved : GeoDataFrame
+        Merged buildings, with `building_id`, height and `geometry` columns.
+    mapping : DataFrame
+        The original `building_id` and the `dissolved_id` of the merged building it belongs to.
+    '''
+    geometry = np.asarray(buildings['geometry'])
+    heights = buildings[height].values.astype(float)
+    if height_bin is not None:
+        heights = bin_heights(heights, height_bin)
+
+    # 相邻且同高的建筑对
+    tree = shapely.STRtree(geometry)
+    a, b = tree.query(geometry, predicate='intersects')
+    keep = (a < b) & (heights[a] == heights[b])
+    a, b = a[keep], b[keep]
+    # 只有一个角点相接的不合并
+    shared = shapely.length(shapely.intersection(geometry[a], geometry[b])) > 0
+    labels = connected_components(len(geometry), a[shared], b[shared])
+
+    groups, unions = union_by_group(geometry, labels)
+    # 去除合并后共线的顶点
+    unions = shapely.simplify(unions, 0)
+    # 每组第一个建筑的位置，与groups同序
+    _, first = np.unique(labels, return_index=True)
+    dissolved = gpd.GeoDataFrame({'building_id': groups, height: heights[first]},
+                                 geometry=list(unions), crs=buildings.crs)
+    mapping = pd.DataFrame({'building_id': buildings['building_id'].values,
+                            'dissolved_id': labels})
+    return dissolved, mapping
+
+
 def gdf_difference(gdf_a,gdf_b,col = 'building_id'):
     '''
     difference gdf_b from gdf_a
-    '''
-    gdfa = gdf_a.copy()
-    gdfb = gdf_b.copy()
-    gdfb = gdfb[['geometry']]
-    #判断重叠
 
-    gdfa.crs = gdfb.crs
-    gdfb = gpd.sjoin(gdfb,gdfa).groupby([col])['geometry'].apply(
-            lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-    #分割有重叠和无重叠的
-    gdfb['tmp'] = 1
-    gdfa_1 = pd.merge(gdfa,gdfb[[col,'tmp']],how = 'left')
-    gdfa = gdfa_1[gdfa_1['tmp'] == 1].drop('tmp',axis = 1)
-    gdfa_notintersected = gdfa_1[gdfa_1['tmp'].isnull()].drop('tmp',axis = 1)
-    #对有重叠的进行裁剪
-    gdfa = gdfa.sort_values(by = col).set_index(col)
-    gdfb = gdfb.sort_values(by = col).set_index(col)
-    gdfa.crs = gdfb.crs
-    gdfa['geometry'] = gdfa.difference(gdfb).buffer(0)
-    gdfa = gdfa.reset_index()
-    #拼合
-    gdfa = pd.concat([gdfa,gdfa_notintersected])
+    The rows of gdf_a intersecting gdf_b come first, sorted by `col`,
+    followed by the rows not intersected, which are kept unchanged.
+    The result is in the crs of gdf_b.
+    '''
+    rows, cover = _overlay_cover(gdf_a, gdf_b)
+    geometry = np.asarray(gdf_a['geometry'])
+    clipped = shapely.buffer(shapely.difference(geometry[rows], cover), 0)
+    gdfa = _overlay_result(gdf_a, gdf_b, rows, clipped, col)
+    #拼合无重叠的
+    notintersected = np.ones(len(gdf_a), dtype=bool)
+    notintersected[rows] = False
+    gdfa_notintersected = gdf_a[notintersected].set_crs(gdf_b.crs, allow_override = True)
+    gdfa_notintersected.index = np.flatnonzero(notintersected)
+    gdfa = pd.concat([gdfa, gdfa_notintersected])
     return gdfa
 
 def gdf_intersect(gdf_a,gdf_b,col = 'building_id'):
     '''
     intersect gdf_b from gdf_a
+
+    Only the rows of gdf_a intersecting gdf_b are returned, sorted by `col`.
+    The result is in the crs of gdf_b.
+    '''
+    rows, cover = _overlay_cover(gdf_a, gdf_b)
+    geometry = np.asarray(gdf_a['geometry'])
+    clipped = shapely.buffer(shapely.intersection(geometry[rows], cover), 0)
+    return _overlay_result(gdf_a, gdf_b, rows, clipped, col)
+
+def _overlay_cover(gdf_a, gdf_b):
+    '''
+    Union the geometries of gdf_b intersecting each row of gdf_a.
+
+    Return the positions of the intersected rows of gdf_a, and the union of
+    the gdf_b geometries intersecting each of them.
     '''
-    gdfa = gdf_a.copy()
-    gdfb = gdf_b.copy()
-    gdfb = gdfb[['geometry']]
     #判断重叠
-    gdfa.crs = gdfb.crs
-    gdfb = gpd.sjoin(gdfb,gdfa).groupby([col])['geometry'].apply(
-            lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-    #分割有重叠和无重叠的
-    gdfb['tmp'] = 1
-    gdfa_1 = pd.merge(gdfa,gdfb[[col,'tmp']],how = 'left')
-    gdfa = gdfa_1[gdfa_1['tmp'] == 1].drop('tmp',axis = 1)
-    #对有重叠的进行裁剪
-    gdfa = gdfa.sort_values(by = col).set_index(col)
-    gdfb = gdfb.sort_values(by = col).set_index(col)
-    gdfa.crs = gdfb.crs
-    gdfa['geometry'] = gdfa.intersection(gdfb).buffer(0)
-    gdfa = gdfa.reset_index()
-
-    return gdfa
\ No newline at end of file
+    geometry_b = np.asarray(gdf_b['geometry'])
+    tree = shapely.STRtree(geometry_b)
+    row, other = tree.query(np.asarray(gdf_a['geometry']), predicate='intersects')
+    return union_by_group(geometry_b[other], row)
+
+def _overlay_result(gdf_a, gdf_b, rows, clipped, col):
+    '''
+    Build the overlay result of the intersected rows, sorted by `col` with `col` first.
+    '''
+    gdfa = gdf_a.iloc[rows].copy()
+    gdfa['geometry'] = clipped
+    gdfa = gdfa.sort_values(by = col)
+    columns = [col]+[c for c in gdfa.columns if c != col]
+    gdfa = gdfa[columns].reset_index(drop = True)
+    gdfa = gdfa.set_crs(gdf_b.crs, allow_override = True)
+    return gdfa
+
+class PreparedBuildings:
+    '''
+    Buildings prepared for shadow calculation.
+
+    The walls, heights, projected coordinates and spatial indexes of the buildings do not depend on the
+    sun position, they are derived once and shared by all the timestamps and calls.
+    Create it with `prepare_buildings`.
+
+    Attributes
+    ----------
+    source : GeoDataFrame
+        The input buildings.
+    buildings : GeoDataFrame
+        The buildings higher than the ground, heights measured from the ground.
+    height : string
+        Column name of building height(meter).
+    ground : number
+        Height of the ground(meter).
+    height_bin : number or None
+        Size of the height bins(meter).
+    height_rounding : str
+        How the heights are rounded to the bins.
+    simplify_tolerance : number or None
+        Tolerance(meter) of the footprint simplification.
+    crs : pyproj.CRS
+        Coordinate system of the input buildings.
+    projection : LocalProjection or MetricProjection
+        Projection of the buildings, the shadows are calculated in meters.
+        Buildings in a projected coordinate system are used directly in their own coordinates.
+    building_id : numpy.ndarray
+        building_id of each building.
+    heights : numpy.ndarray
+        Height of each building(meter).
+    footprints : numpy.ndarray
+        Projected outline of each building.
+    bounds : numpy.ndarray
+        Projected bounds of each building, shape = [n,4]
+    convex : numpy.ndarray
+        Whether each outline is convex and has no holes.
+    walls : numpy.ndarray
+        Projected wall coordinates, shape = [m,2,2]
+    wall_index : numpy.ndarray
+        Positional index of the building that each wall belongs to, shape = [m]
+    wall_offsets : numpy.ndarray
+        The walls of building i are walls[wall_offsets[i]:wall_offsets[i+1]], shape = [n+1]
+    normals : numpy.ndarray
+        Outward normal of each wall, shape = [m,2]
+    wall_cullable : numpy.ndarray
+        Whether each wall can be skipped when facing the sun, false for the buildings with holes.
+    tree : shapely.STRtree
+        Spatial index of the footprints.
+    obstacles : numpy.ndarray
+        Projected outline of all the input buildings, including those not higher than the ground.
+    obstacle_tree : shapely.STRtree
+        Spatial index of the obstacles.
+    '''
+
+    def __init__(self, buildings, height='height', ground=0, height_bin=None, height_rounding='nearest',
+                 simplify_tolerance=None):
+        self.source = buildings
+        self.height = height
+        self.ground = ground
+        self.height_bin = height_bin
+        self.height_rounding = height_rounding
+        self.crs = buildings.crs
+
+        building = buildings.copy()
+        building[height] -= ground
+        building = building[building[height] > 0]
+        if height_bin is not None:
+            # 高度分箱，屋顶阴影的层数不超过分箱数
+            building[height] = bin_heights(building[height].values, height_bin, height_rounding)
+            building = building[building[height] > 0]
+        self.buildings = building
+
+        # 投影中心为建筑范围的中心，米制坐标系的数据不做投影
+        center = building if len(building) > 0 else buildings
+        self.projection = get_projection(center['geometry'], self.crs)
+
+        self.building_id = building['building_id'].values
+        self.heights = building[height].values.astype(float)
+        self.footprints = self.projection.forward_geometry(building['geometry'])
+        self.simplify_tolerance = simplify_tolerance
+        if simplify_tolerance is not None:
+            self.footprints, _ = simplify_footprints(self.footprints, simplify_tolerance)
+        self.bounds = shapely.bounds(self.footprints).reshape((-1, 4))
+        self.convex = is_convex(self.footprints)
+
+        self.walls, self.wall_index = bd_to_walls(self.footprints)
+        self.wall_offsets = np.concatenate(
+            [[0], np.cumsum(np.bincount(self.wall_index, minlength=len(building)))])
+        self.normals = wall_normals(self.walls, self.wall_index)
+        self.wall_cullable = (shapely.get_num_interior_rings(
+            self.footprints) == 0)[self.wall_index]
+
+        self.tree = shapely.STRtree(self.footprints)
+        # 裁剪用的建筑轮廓与计算阴影的轮廓一致
+        self.obstacles = self.projection.forward_geometry(buildings['geometry'])
+        if simplify_tolerance is not None:
+            self.obstacles, _ = simplify_footprints(self.obstacles, simplify_tolerance)
+        self.obstacle_tree = shapely.STRtree(self.obstacles)
+
+    def __len__(self):
+        return len(self.buildings)
+
+    def __repr__(self):
+        return '<PreparedBuildings: %d buildings, %d walls>' % (len(self.buildings), len(self.walls))
+
+
+def prepare_buildings(buildings, height='height', ground=0, height_bin=None, height_rounding='nearest',
+                      simplify_tolerance=None):
+    '''
+    Prepare the buildings for shadow calculation.
+
+    The result can be passed to `bdshadow_sunlight`, `bdshadow_pointlight`, `bdshadow_pointlights`,
+    `cal_sunshadows`, `cal_sunshine` and `cal_shadowcoverage` in place of the buildings, so that the
+    walls, projected coordinates and spatial indexes are only derived once.
+
+    Parameters
+    --------------
+    buildings : GeoDataFrame
+        Buildings, preprocessed by `bd_preprocess`. coordinate system should be WGS84,
+        or a projected coordinate system in meters to calculate the shadows in its own coordinates.
+    height : string
+        Column name of building height(meter).
+    ground : number
+        Height of the ground(meter).
+    height_bin : number or None
+        Size of the height bins(meter), see `bin_heights`. The cost of the roof shadows grows with the
+        number of distinct heights, binning bounds it by the number of bins. If None, the heights are kept.
+    height_rounding : str
+        'nearest' or 'ceil', how the heights are rounded to the bins.
+    simplify_tolerance : number or None
+        Simplify the footprints with this tolerance(meter) before extracting the walls, see `bd_simplify`.
+        If None, the footprints are kept.
+
+    Returns
+    --------------
+    prepared : PreparedBuildings
+        Prepared buildings. If `buildings` is already prepared, it is returned unchanged,
+        and a ValueError is raised if the given parameters differ from those it was prepared with.
+    '''
+    if isinstance(buildings, PreparedBuildings):
+        # 已预处理的建筑直接返回，非默认参数需与预处理时一致
+        params = {'height': (height, 'height'), 'ground': (ground, 0),
+                  'height_bin': (height_bin, None), 'height_rounding': (height_rounding, 'nearest'),
+                  'simplify_tolerance': (simplify_tolerance, None)}
+        conflicts = [name for name, (value, default) in params.items()
+                     if value != default and value != getattr(buildings, name)]
+        if len(conflicts) > 0:
+            raise ValueError('The buildings are already prepared with different ' + ', '.join(conflicts) +
+                             ', pass the original buildings instead')
+        return buildings
+    return PreparedBuildings(buildings, height=height, ground=ground,
+                             height_bin=height_bin, height_rounding=height_rounding,
+                             simplify_tolerance=simplify_tolerance)
+
+
+def bin_heights(heights, height_bin, height_rounding='nearest'):
+    '''
+    Quantize the building heights into bins.
+
+    A shadow of a building of height H is H / tan(altitude) long, so a height error of dH changes
+    the shadow length by dH / tan(altitude). The worst-case error on the shadow length is
+
+    - height_bin / (2 * tan(altitude)) with 'nearest', the shadows can be shorter or longer.
+    - height_bin / tan(altitude) with 'ceil', the shadows are never shorter than the exact ones.
+
+    Parameters
+    --------------
+    heights : numpy.ndarray
+        Building heights(meter).
+    height_bin : number
+        Size of the height bins(meter).
+    height_rounding : str
+        'nearest' or 'ceil'.
+
+    Returns
+    --------------
+    heights : numpy.ndarray
+        Binned heights, multiples of `height_bin`.
+    '''
+    if height_bin <= 0:
+        raise ValueError('height_bin should be positive')
+    heights = np.asarray(heights, dtype=float)/height_bin
+    if height_rounding == 'nearest':
+        heights = np.round(heights)
+    elif height_rounding == 'ceil':
+        heights = np.ceil(heights)
+    else:
+        raise ValueError("height_rounding should be 'nearest' or 'ceil'")
+    return heights*height_bin
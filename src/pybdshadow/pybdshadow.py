@@ -31,15 +31,122 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import pandas as pd
 import geopandas as gpd
+import shapely
 from suncalc import get_position
-from shapely.geometry import Polygon, MultiPolygon
-import math
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from .utils import (
+    snap_to_grid,
+    spatial_chunks,
+    union_by_group,
     lonlat2aeqd,
-    aeqd2lonlat
+    aeqd2lonlat,
 )
-from .preprocess import gdf_difference,gdf_intersect
+from .preprocess import (
+    prepare_buildings,
+)
+
+
+def get_sun_positions(dates, lon, lat):
+    '''
+    Obtain the sun positions for a list of datetimes.
+
+    Parameters
+    ----------
+    dates : list
+        List of datetimes(UTC or timezone aware).
+    lon, lat : float
+        Location to calculate the sun position.
+
+    Returns
+    -------
+    sunPositions : numpy.ndarray
+        Sun azimuth and altitude in radians, shape = [T,2]
+    '''
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    if dates.tz is not None:
+        dates = dates.tz_convert('UTC').tz_localize(None)
+    # suncalc converts datetime arrays to milliseconds assuming nanoseconds
+    dates = dates.astype('datetime64[ns]')
+    sunPositions = get_position(dates, lon, lat)
+    return np.column_stack([np.asarray(sunPositions['azimuth'], dtype=float),
+                            np.asarray(sunPositions['altitude'], dtype=float)])
+
+
+def get_prepared_sun_positions(prepared, dates):
+    '''
+    Obtain the sun positions at the center of the prepared buildings.
+    The projected coordinates of the prepared buildings point to true east and north,
+    so the azimuth applies to them directly.
+
+    Parameters
+    ----------
+    prepared : PreparedBuildings
+        Prepared buildings.
+    dates : list
+        List of datetimes(UTC or timezone aware).
+
+    Returns
+    -------
+    sunPositions : numpy.ndarray
+        Sun azimuth and altitude in radians, shape = [T,2]
+    '''
+    projection = prepared.projection
+    return get_sun_positions(dates, projection.center_lon, projection.center_lat)
+
+
+def calSunShadow_vector_batch(shape, shapeHeight, sunPositions, projected=False):
+    '''
+    Calculate the shadow of buildings on the ground for multiple sun positions at once.
+
+    Parameters
+    ----------
+    shape : numpy.ndarray
+        The shape of the building. The shape of the array is (n,2,2), where n the number of walls, 2 is that each wall has two points, and the last dimension is for longitude and latitude.
+    shapeHeight : numpy.ndarray
+        The height of the walls, shape = [n]
+    sunPositions : numpy.ndarray
+        The positions of the sun, shape = [T,2], the columns are azimuth and altitude.
+    projected : bool
+        Whether `shape` is already in projected coordinates(meter). If so, the shadow is returned in the same coordinates without conversion.
+
+    Returns
+    -------
+    shadow : numpy.ndarray
+        The shadow of the walls on the ground for each sun position. shape = [T,n,5,2]
+    '''
+    # transform coordinate system
+    if not projected:
+        meanlon = shape[:,:,0].mean()
+        meanlat = shape[:,:,1].mean()
+        shape = lonlat2aeqd(shape,meanlon,meanlat)
+
+    sunPositions = np.asarray(sunPositions, dtype=float).reshape((-1, 2))
+    azimuth = sunPositions[:, 0].reshape((-1, 1))
+    altitude = sunPositions[:, 1].reshape((-1, 1))
+
+    n = np.shape(shape)[0]
+    T = len(sunPositions)
+    distance = np.asarray(shapeHeight, dtype=float).reshape((1, n))/np.tan(altitude)
+
+    # calculate the offset of the projection position, shape = [T,n,1]
+    lonDistance = (distance*np.sin(azimuth)).reshape((T, n, 1))
+    latDistance = (distance*np.cos(azimuth)).reshape((T, n, 1))
+
+    shadowShape = np.zeros((T, n, 5, 2)) # T sun positions, n walls, each wall shadow has 5 points, each point has 2 dimensions
+
+    shadowShape[:, :, 0:2, :] += shape
+    # the projected points are stored in reverse order to close the quad
+    shadowShape[:, :, 2, 0] = shape[:, 1, 0] + lonDistance[:, :, 0]
+    shadowShape[:, :, 2, 1] = shape[:, 1, 1] + latDistance[:, :, 0]
+    shadowShape[:, :, 3, 0] = shape[:, 0, 0] + lonDistance[:, :, 0]
+    shadowShape[:, :, 3, 1] = shape[:, 0, 1] + latDistance[:, :, 0]
+    shadowShape[:, :, 4, :] = shadowShape[:, :, 0, :]
+
+    if not projected:
+        shadowShape = aeqd2lonlat(
+            shadowShape.reshape((T*n, 5, 2)), meanlon, meanlat).reshape((T, n, 5, 2))
+    return shadowShape
 
 
 def calSunShadow_vector(shape, shapeHeight, sunPosition):
@@ -60,46 +167,56 @@ def calSunShadow_vector(shape, shapeHeight, sunPosition):
     shadow : numpy.ndarray
         The shadow of the building on the ground. shape = [n,5,2]
     '''
-    # transform coordinate system
-    meanlon = shape[:,:,0].mean()
-    meanlat = shape[:,:,1].mean()
-    shape = lonlat2aeqd(shape,meanlon,meanlat)
-
-    azimuth = sunPosition['azimuth']
-    altitude = sunPosition['altitude']
-
+    sunPositions = [[sunPosition['azimuth'], sunPosition['altitude']]]
     n = np.shape(shape)[0]
-    distance = shapeHeight/math.tan(altitude)
-
-    # calculate the offset of the projection position
-    lonDistance = distance*math.sin(azimuth) 
-    lonDistance = lonDistance.reshape((n, 1))
-    latDistance = distance*math.cos(azimuth)
-    latDistance = latDistance.reshape((n, 1))
+    shapeHeight = np.broadcast_to(np.asarray(shapeHeight, dtype=float).ravel(), (n,))
+    return calSunShadow_vector_batch(shape, shapeHeight, sunPositions)[0]
 
-    shadowShape = np.zeros((n, 5, 2)) # n buildings, each building has 5 points, each point has 2 dimensions
 
-    shadowShape[:, 0:2, :] += shape  
-    shadowShape[:, 2:4, 0] = shape[:, :, 0] + lonDistance
-    shadowShape[:, 2:4, 1] = shape[:, :, 1] + latDistance
+def merge_wall_shadows(shadowShape, walls_id, building):
+    '''
+    Merge the shadows of the walls with the building outlines into the shadow of each building.
 
-    shadowShape[:, [2, 3], :] = shadowShape[:, [3, 2], :]
-    shadowShape[:, 4, :] = shadowShape[:, 0, :]
+    Parameters
+    ----------
+    shadowShape : numpy.ndarray
+        The shadow of the walls, shape = [n,5,2], or the shadow polygons of the walls.
+    walls_id : numpy.ndarray
+        The building_id of each wall, shape = [n]
+    building : GeoDataFrame
+        Buildings, with `building_id` column.
 
-    shadowShape = aeqd2lonlat(shadowShape,meanlon,meanlat)
-    return shadowShape
+    Returns
+    -------
+    shadows : GeoDataFrame
+        Building shadow, with `building_id` and `geometry` columns.
+    '''
+    quads = np.asarray(shadowShape)
+    if quads.dtype != object:
+        quads = shapely.polygons(quads)
+    # walls parallel to the light cast no shadow
+    has_area = shapely.area(quads) > 0
+    building_id, geometry = union_by_group(
+        np.concatenate([quads[has_area], np.asarray(building['geometry'])]),
+        np.concatenate([walls_id[has_area], building['building_id'].values]))
+    shadows = gpd.GeoDataFrame({'building_id': building_id},
+                               geometry=list(geometry), crs=building.crs)
+    return shadows
 
 
-def bdshadow_sunlight(buildings, date,  height='height', roof=False,include_building = True,ground=0):
+def bdshadow_sunlight(buildings, date,  height='height', roof=False,include_building = True,ground=0,
+                      cull_walls=True, cleanup='precision', grid_size=None, height_bin=None, workers=None):
     '''
     Calculate the sunlight shadow of the buildings.
 
     Parameters
     ----------
-    buildings : GeoDataFrame
-        Buildings. coordinate system should be WGS84
-    date : datetime
-        Datetime
+    buildings : GeoDataFrame or PreparedBuildings
+        Buildings. coordinate system should be WGS84, or a projected coordinate system in meters.
+        Buildings prepared by `prepare_buildings` can be given to reuse their walls and spatial indexes,
+        in which case `height` and `ground` are taken from the prepared buildings.
+    date : datetime or list
+        Datetime, or a list of datetimes to calculate the shadows of all of them in one batch.
     height : string
         Column name of building height(meter).
     roof : bool
@@ -108,140 +225,573 @@ def bdshadow_sunlight(buildings, date,  height='height', roof=False,include_buil
         Whether the shadow include building outline.
     ground : number
         Height of the ground(meter).
+    cull_walls : bool
+        Whether to skip the walls facing the sun. Their shadows are always covered by the
+        building outline and the shadows of the other walls, so the result is the same
+        with about half of the polygons. Buildings with holes are never culled.
+    cleanup : str or None
+        Cleanup of the shadows in roof mode, where the roof and ground shadows come from separate overlays.
+
+        - 'precision' : snap the coordinates to a 1 mm grid, which merges near-coincident edges and keeps the polygons valid.
+        - 'make_valid' : only repair the invalid polygons.
+        - 'buffer' : close the small gaps with a 0.1 m buffer and debuffer, slower and adds vertices.
+        - None : no cleanup, for consumers that only rasterize the shadows.
+
+        Shadows that collapse to empty geometries are dropped.
+    grid_size : float
+        Precision of the output coordinates, in the unit of the coordinate system of the buildings,
+        e.g. 1e-7 for degrees or 0.01 for meters. The coordinates are snapped to this grid and the
+        redundant vertices are removed, see `snap_to_grid`. If None, the full precision is kept.
+    height_bin : number
+        Round the building heights to bins of this size(meter) to bound the number of roof levels,
+        the shadow length error is at most height_bin / (2 * tan(altitude)), see `bin_heights`.
+    workers : int
+        Number of threads used to calculate the shadows. The buildings are split into spatially
+        coherent chunks(see `spatial_chunks`), whose wall shadows and unions are calculated in parallel.
+        The roof shadows are split by the chunk of the roof, with occluders taken from all the chunks.
+        The result does not depend on the number of workers. If None, all the buildings are calculated in one batch.
 
     Returns
     ----------
     shadows : GeoDataFrame
-        Building shadow
+        Building shadow. If `date` is a list, the shadows of all datetimes are concatenated and a `date` column is added.
     '''
 
-    building = buildings.copy()
-
-    building[height] -= ground
-    building = building[building[height] > 0]
-
-    # calculate position
-    lon1, lat1, lon2, lat2 = list(building.bounds.mean())
-    lon = (lon1+lon2)/2
-    lat = (lat1+lat2)/2
+    prepared = prepare_buildings(buildings, height=height, ground=ground, height_bin=height_bin)
 
     # obtain sun position
-    sunPosition = get_position(date, lon, lat)
-    if ( sunPosition['altitude']<0):
+    batch = pd.api.types.is_list_like(date)
+    dates = list(date) if batch else [date]
+    sunPositions = get_prepared_sun_positions(prepared, dates)
+    if (sunPositions[:, 1] < 0).any():
         raise ValueError("Given time before sunrise or after sunset")   # pragma: no cover
-    buildingshadow = building.copy()
-
-    a = buildingshadow['geometry'].apply(lambda r: list(r.exterior.coords))
-    buildingshadow['wall'] = a
-    buildingshadow = buildingshadow.set_index(['building_id'])
-    a = buildingshadow.apply(lambda x: pd.Series(x['wall']), axis=1).unstack()
-    walls = a[- a.isnull()].reset_index().sort_values(
-        by=['building_id', 'level_0'])
-    walls = pd.merge(walls, buildingshadow['height'].reset_index())
-    walls['x1'] = walls[0].apply(lambda r: r[0])
-    walls['y1'] = walls[0].apply(lambda r: r[1])
-    walls['x2'] = walls['x1'].shift(-1)
-    walls['y2'] = walls['y1'].shift(-1)
-    walls = walls[walls['building_id'] == walls['building_id'].shift(-1)]
-    walls = walls[['x1', 'y1', 'x2', 'y2', 'building_id', 'height']]
-    walls['wall'] = walls.apply(lambda r: [[r['x1'], r['y1']],
-                                           [r['x2'], r['y2']]], axis=1)
-
-    ground_shadow = walls.copy()
-    walls_shape = np.array(list(ground_shadow['wall']))
-
-    # calculate shadow for walls
-    shadowShape = calSunShadow_vector(
-        walls_shape, ground_shadow['height'].values, sunPosition)
-
-    ground_shadow['geometry'] = list(shadowShape)
-    ground_shadow['geometry'] = ground_shadow['geometry'].apply(
-        lambda r: Polygon(r))
-    ground_shadow = gpd.GeoDataFrame(ground_shadow)
-
-
-
-    ground_shadow = pd.concat([ground_shadow, building])
-    ground_shadow = ground_shadow.groupby(['building_id'])['geometry'].apply(
-        lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-    
-    ground_shadow['height'] = 0
-    ground_shadow['type'] = 'ground'
 
+    if workers is None:
+        return _bdshadow_sunlight_dates(
+            prepared, dates, sunPositions, batch, roof, include_building, cull_walls, cleanup, grid_size)
+    chunks = spatial_chunks(prepared.footprints, 4*workers)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return _bdshadow_sunlight_dates(
+            prepared, dates, sunPositions, batch, roof, include_building, cull_walls, cleanup, grid_size,
+            chunks, executor)
+
+
+def _bdshadow_sunlight_dates(prepared, dates, sunPositions, batch, roof, include_building, cull_walls,
+                             cleanup, grid_size, chunks=None, executor=None):
+    '''
+    Calculate the sunlight shadows of the prepared buildings at each sun position.
+    The ground shadows of all the sun positions are calculated and converted in one batch,
+    the roof shadows one sun position at a time.
+    '''
+    projection = prepared.projection
+    ground = _ground_shadows(prepared, sunPositions, include_building, cull_walls, chunks, executor)
     if not roof:
-        if not include_building:
-            #从地面阴影裁剪建筑轮廓
-            ground_shadow = gdf_difference(ground_shadow,buildings)
-        return ground_shadow
-    else:
-        def calwall_shadow(walldata, building):
-            walls = walldata.copy()
-            walls_shape = np.array(list(walls['wall']))
-            # calculate shadow for walls
-            shadowShape = calSunShadow_vector(
-                walls_shape, walls['height'].values, sunPosition)
-            walls['geometry'] = list(shadowShape)
-            walls['geometry'] = walls['geometry'].apply(lambda r: Polygon(r))
-            walls = gpd.GeoDataFrame(walls)
-            walls = pd.concat([walls, building])
-
-            walls = walls.groupby(['building_id'])['geometry'].apply(
-                lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-            return walls
+        shadows = _ground_frame(prepared, ground)
+        shadows['geometry'] = projection.inverse_geometry(shadows['geometry'])
+        shadows = shadows.set_crs(prepared.crs, allow_override=True)
+        if batch:
+            shadows['date'] = pd.Series(dates).repeat(len(prepared)).values
+        return _snap_shadows(shadows, grid_size)
 
+    allshadows = []
+    for i in range(len(dates)):
+        sunPosition = {'azimuth': sunPositions[i, 0],
+                       'altitude': sunPositions[i, 1]}
         # 计算屋顶阴影
-        roof_shadows = []
-        for roof_height in walls[height].drop_duplicates():
-            # 高于给定高度的墙
-            walls_high = walls[walls[height] > roof_height].copy()
-            if len(walls_high) == 0:
-                continue
-            walls_high[height] -= roof_height
-            # 高于给定高度的建筑
-            building_high = building[building[height] > roof_height].copy()
-            if len(building_high) == 0:
-                continue
-            building_high[height] -= roof_height
-            # 所有建筑在此高度的阴影
-            building_shadow_height = calwall_shadow(walls_high, building_high)
-            # 在此高度的建筑屋顶
-            building_roof = building[building[height] == roof_height].copy()
-            building_shadow_height.crs = building_roof.crs
-            # 取有遮挡的阴影
-            building_shadow_height = gpd.sjoin(
-                gpd.GeoDataFrame(building_shadow_height), gpd.GeoDataFrame(building_roof))
-            if len(building_shadow_height) == 0:
-                continue
-            # 与屋顶做交集
-            building_roof = gdf_intersect(building_roof,building_shadow_height)
-
-            # 再减去这个高度以上的建筑
-            building_higher = building[building[height] > roof_height].copy()
-            building_roof = gdf_difference(building_roof,building_higher)
-            
-            #给出高度信息
-            building_roof['height'] = roof_height
-            building_roof = building_roof[-building_roof['geometry'].is_empty]
-
-            roof_shadows.append(building_roof)
-        if len(roof_shadows) == 0:
-            roof_shadow = gpd.GeoDataFrame()
-        else:
-            roof_shadow = pd.concat(roof_shadows)[
-                ['height', 'building_id', 'geometry']]
-            roof_shadow['type'] = 'roof'
+        roof_shadow = _roof_shadows(prepared, sunPosition, cull_walls, chunks, executor)
+        shadows = pd.concat([roof_shadow, _ground_frame(prepared, ground[[i]])])
+        shadows = cleanup_shadows(shadows, cleanup)
+        shadows['geometry'] = projection.inverse_geometry(shadows['geometry'])
+        shadows = shadows.set_crs(prepared.crs, allow_override=True)
+        shadows = _snap_shadows(shadows, grid_size)
+        if not batch:
+            return shadows
+        shadows['date'] = dates[i]
+        allshadows.append(shadows)
+    return pd.concat(allshadows)
 
+
+def _ground_shadows(prepared, sunPositions, include_building, cull_walls, chunks=None, executor=None):
+    '''
+    Calculate the ground shadows of the prepared buildings at all the sun positions, shape = [T,n]
+    The buildings are calculated by chunks on the executor if given, see `bdshadow_sunlight`.
+    '''
+    def ground_chunk(chunk):
+        geometry = sweep_shadows_batch(
+            prepared, chunk, prepared.heights[chunk], sunPositions, cull_walls)
         if not include_building:
             #从地面阴影裁剪建筑轮廓
-            ground_shadow = gdf_difference(ground_shadow,buildings)
-        
-        shadows = pd.concat([roof_shadow, ground_shadow])
-        shadows.crs = None
-        shadows['geometry'] = shadows.buffer(0.000001).buffer(-0.000001)
+            geometry = _subtract_footprints(
+                geometry.ravel(), prepared.obstacles, prepared.obstacle_tree).reshape(geometry.shape)
+        return geometry
+
+    if chunks is None:
+        chunks = [np.arange(len(prepared))]
+    geometry = np.empty((len(sunPositions), len(prepared)), dtype=object)
+    for chunk, result in zip(chunks, _map_chunks(ground_chunk, chunks, executor)):
+        geometry[:, chunk] = result
+    return geometry
+
+
+def _ground_frame(prepared, ground):
+    '''
+    Build the ground shadows of each sun position in projected coordinates, sorted by building_id.
+    '''
+    T, n = ground.shape
+    order = np.argsort(prepared.building_id, kind='stable')
+    ground_shadow = gpd.GeoDataFrame(
+        {'building_id': np.tile(prepared.building_id[order], T)},
+        geometry=list(ground[:, order].ravel()), index=np.tile(np.arange(n), T))
+    ground_shadow['height'] = 0
+    ground_shadow['type'] = 'ground'
+    return ground_shadow
+
+
+def _map_chunks(func, chunks, executor=None):
+    '''
+    Apply func to each chunk, on the executor if given, and return the results in the order of the chunks.
+    '''
+    if executor is None:
+        return [func(chunk) for chunk in chunks]
+    return list(executor.map(func, chunks))
+
+
+def cleanup_shadows(shadows, cleanup='precision'):
+    '''
+    Clean up the shadow geometries in projected coordinates(meter).
+
+    Parameters
+    ----------
+    shadows : GeoDataFrame
+        Shadows in projected coordinates.
+    cleanup : str or None
+        'precision', 'make_valid', 'buffer' or None, see `bdshadow_sunlight`.
+
+    Returns
+    -------
+    shadows : GeoDataFrame
+        Cleaned shadows, without empty geometries.
+    '''
+    if cleanup is None:
         return shadows
+    geometry = np.asarray(shadows['geometry'])
+    if cleanup == 'precision':
+        # 坐标对齐到 1 mm 网格，结果总是有效的
+        geometry = shapely.set_precision(geometry, 0.001)
+    elif cleanup == 'make_valid':
+        invalid = ~shapely.is_valid(geometry)
+        geometry = geometry.copy()
+        geometry[invalid] = shapely.make_valid(
+            geometry[invalid], method='structure', keep_collapsed=False)
+    elif cleanup == 'buffer':
+        # 闭运算去除细缝，容差单位为米
+        geometry = shapely.buffer(shapely.buffer(geometry, 0.1), -0.1)
+    else:
+        raise ValueError("cleanup should be 'precision', 'make_valid', 'buffer' or None")
+    shadows = shadows.copy()
+    shadows['geometry'] = geometry
+    return shadows[~shapely.is_empty(geometry)]
+
+
+def _snap_shadows(shadows, grid_size):
+    '''
+    Snap the output shadows to the coordinate grid and drop the collapsed ones.
+    '''
+    if grid_size is None:
+        return shadows
+    geometry = snap_to_grid(shadows['geometry'], grid_size)
+    shadows = shadows.copy()
+    shadows['geometry'] = geometry
+    return shadows[~shapely.is_empty(geometry)]
+
+
+def bdshadow_sunlight_stats(buildings, date, height='height', ground=0):
+    '''
+    Calculate the statistics of the sunlight shadow of the buildings without building the shadow geometries.
+
+    The ground shadow of a building is its footprint P swept along the shadow vector of length
+    L = height / tan(altitude). Its area satisfies
+
+        area(P) + L * W <= shadow area <= area(hull(P)) + L * W
+
+    where W is the width of the footprint perpendicular to the shadow direction. The two bounds are equal,
+    so the area is exact, for convex footprints. The extent of the shadow is always exact, it is taken from
+    the vertices of the footprint and of the translated footprint in the coordinate system of the buildings.
+    Shadows overlapping other buildings or shadows are not subtracted.
+
+    Parameters
+    ----------
+    buildings : GeoDataFrame or PreparedBuildings
+        Buildings. coordinate system should be WGS84, or a projected coordinate system in meters.
+    date : datetime or list
+        Datetime, or a list of datetimes.
+    height : string
+        Column name of building height(meter).
+    ground : number
+        Height of the ground(meter).
+
+    Returns
+    ----------
+    stats : DataFrame
+        Shadow statistics of each building at each datetime, with the columns of
+        `building_id`, `date`(if `date` is a list), `length`(shadow length, meter),
+        `area_lower` and `area_upper`(bounds of the shadow area including the footprint, square meter),
+        `error`(area_upper - area_lower) and `minx`, `miny`, `maxx`, `maxy`(shadow extent in the coordinate system of the buildings).
+    '''
+    prepared = prepare_buildings(buildings, height=height, ground=ground)
+    projection = prepared.projection
+
+    batch = pd.api.types.is_list_like(date)
+    dates = list(date) if batch else [date]
+    sunPositions = get_sun_positions(dates, projection.center_lon, projection.center_lat)
+    if (sunPositions[:, 1] < 0).any():
+        raise ValueError("Given time before sunrise or after sunset")   # pragma: no cover
+    azimuth = sunPositions[:, 0]
+    # shadow direction and its normal, shape = [T,2]
+    direction = np.column_stack([np.sin(azimuth), np.cos(azimuth)])
+    normal = np.column_stack([-direction[:, 1], direction[:, 0]])
+    lengths = prepared.heights.reshape((-1, 1))/np.tan(sunPositions[:, 1])  # [n,T]
+
+    # footprint width perpendicular to the shadow and shadow extent, from the vertices of each building
+    vertices = prepared.walls[:, 0, :]
+    starts = prepared.wall_offsets[:-1]
+    width = np.zeros((len(prepared), len(dates)))
+    extent = np.zeros((4, len(prepared), len(dates)))
+    # the shadow spans the footprint and the translated footprint, its extent is that of their vertices
+    lonlat = projection.inverse(vertices)
+    footprint_min = np.minimum.reduceat(lonlat, starts, axis=0)
+    footprint_max = np.maximum.reduceat(lonlat, starts, axis=0)
+    step = max(1, 10000000//max(len(vertices), 1))
+    for i in range(0, len(dates), step):
+        projected = vertices @ normal[i:i+step].T  # [m,t]
+        width[:, i:i+step] = np.maximum.reduceat(projected, starts, axis=0) - \
+            np.minimum.reduceat(projected, starts, axis=0)
+        translated = projection.inverse(
+            vertices.reshape((-1, 1, 2))+lengths[prepared.wall_index, i:i+step, np.newaxis]*direction[i:i+step])
+        translated_min = np.minimum.reduceat(translated, starts, axis=0)
+        translated_max = np.maximum.reduceat(translated, starts, axis=0)
+        extent[0:2, :, i:i+step] = np.minimum(footprint_min[:, np.newaxis, :], translated_min).transpose((2, 0, 1))
+        extent[2:4, :, i:i+step] = np.maximum(footprint_max[:, np.newaxis, :], translated_max).transpose((2, 0, 1))
+    area = shapely.area(prepared.footprints).reshape((-1, 1))
+    hull_area = shapely.area(shapely.convex_hull(prepared.footprints)).reshape((-1, 1))
+    swept = lengths*width
+    area_lower = area+swept
+    area_upper = np.maximum(hull_area, area)+swept
+
+    # 按时间排列
+    stats = pd.DataFrame({
+        'building_id': np.tile(prepared.building_id, len(dates)),
+        'date': np.repeat(np.array(dates, dtype=object), len(prepared)),
+        'length': lengths.T.ravel(),
+        'area_lower': area_lower.T.ravel(),
+        'area_upper': area_upper.T.ravel(),
+        'minx': extent[0].T.ravel(),
+        'miny': extent[1].T.ravel(),
+        'maxx': extent[2].T.ravel(),
+        'maxy': extent[3].T.ravel()})
+    stats.insert(5, 'error', stats['area_upper']-stats['area_lower'])
+    if not batch:
+        stats = stats.drop(columns='date')
+    else:
+        stats['date'] = pd.to_datetime(stats['date'])
+    return stats
+
+
+def _gather_walls(wall_offsets, targets):
+    '''
+    Gather the walls of the target buildings.
+
+    Returns the positions of the walls and, for each of them, the position of its target.
+    '''
+    wall_starts = wall_offsets[:-1]
+    repeats = np.diff(wall_offsets)[targets]
+    owner = np.repeat(np.arange(len(targets)), repeats)
+    wall_pos = np.repeat(wall_starts[targets]-(np.cumsum(repeats)-repeats), repeats) + \
+        np.arange(repeats.sum())
+    return wall_pos, owner
 
 
-def calPointLightShadow_vector(shape, shapeHeight, pointLight):
+def sweep_shadows(prepared, targets, lengths, sunPosition, cull_walls=True):
+    '''
+    Calculate the shadows of buildings on a horizontal plane.
+
+    The shadow of a convex building is the convex hull of its outline and the outline
+    translated by the shadow vector, so no union is needed. The shadows of the other
+    buildings are the union of their outline and the shadows of their walls.
+
+    Parameters
+    ----------
+    prepared : PreparedBuildings
+        Prepared buildings.
+    targets : numpy.ndarray
+        Positional index of the buildings to calculate, a building may appear several times.
+    lengths : numpy.ndarray
+        Height of each target above the plane(meter).
+    sunPosition : dict
+        The position of the sun. The keys are 'azimuth' and 'altitude'.
+    cull_walls : bool
+        Whether to skip the walls facing the sun, see `walls_facing_away`.
+
+    Returns
+    -------
+    shadows : numpy.ndarray
+        Shadow of each target, including its outline.
+    '''
+    sunPositions = [[sunPosition['azimuth'], sunPosition['altitude']]]
+    return sweep_shadows_batch(prepared, targets, lengths, sunPositions, cull_walls)[0]
+
+
+def sweep_shadows_batch(prepared, targets, lengths, sunPositions, cull_walls=True):
+    '''
+    Calculate the shadows of buildings on a horizontal plane for multiple sun positions at once.
+
+    The hulls and the unions of all the sun positions are built in one pass, see `sweep_shadows`.
+
+    Parameters
+    ----------
+    prepared : PreparedBuildings
+        Prepared buildings.
+    targets : numpy.ndarray
+        Positional index of the buildings to calculate, a building may appear several times.
+    lengths : numpy.ndarray
+        Height of each target above the plane(meter).
+    sunPositions : numpy.ndarray
+        The positions of the sun, shape = [T,2], the columns are azimuth and altitude.
+    cull_walls : bool
+        Whether to skip the walls facing the sun, see `walls_facing_away`.
+
+    Returns
+    -------
+    shadows : numpy.ndarray
+        Shadow of each target at each sun position, including its outline, shape = [T,n]
+    '''
+    walls_shape, footprints, convex = prepared.walls, prepared.footprints, prepared.convex
+    targets = np.asarray(targets)
+    lengths = np.asarray(lengths, dtype=float)
+    sunPositions = np.asarray(sunPositions, dtype=float).reshape((-1, 2))
+    T = len(sunPositions)
+    shadows = np.empty((T, len(targets)), dtype=object)
+    # shadow offset per meter of height, shape = [T,2]
+    directions = np.column_stack([np.sin(sunPositions[:, 0]),
+                                  np.cos(sunPositions[:, 0])])/np.tan(sunPositions[:, [1]])
+
+    # convex buildings: hull of the outline and the translated outline
+    closed_form = np.flatnonzero(convex[targets])
+    k = len(closed_form)
+    if k > 0:
+        wall_pos, owner = _gather_walls(prepared.wall_offsets, targets[closed_form])
+        vertices = walls_shape[wall_pos, 0, :]
+        # shape = [T,m,2]
+        translated = vertices+lengths[closed_form][owner].reshape((1, -1, 1))*directions.reshape((T, 1, 2))
+        points = np.stack([np.broadcast_to(vertices, translated.shape), translated], axis=2).reshape((-1, 2))
+        codes = (np.arange(T).reshape((-1, 1))*k+owner).ravel()
+        shadows[:, closed_form] = shapely.convex_hull(
+            shapely.multipoints(points, indices=np.repeat(codes, 2))).reshape((T, k))
+
+    # other buildings: union of the outline and the wall shadows
+    from_walls = np.flatnonzero(~convex[targets])
+    k = len(from_walls)
+    if k > 0:
+        wall_pos, owner = _gather_walls(prepared.wall_offsets, targets[from_walls])
+        shadowShape = calSunShadow_vector_batch(
+            walls_shape[wall_pos], lengths[from_walls][owner], sunPositions, projected=True)
+        codes = np.arange(T).reshape((-1, 1))*k+owner
+        if cull_walls:
+            facing = np.stack([walls_facing_away(
+                (prepared.normals[wall_pos], prepared.wall_cullable[wall_pos]),
+                {'azimuth': azimuth, 'altitude': altitude}) for azimuth, altitude in sunPositions])
+        else:
+            facing = np.ones(codes.shape, dtype=bool)
+        quads = shapely.polygons(shadowShape[facing])
+        codes = codes[facing]
+        has_area = shapely.area(quads) > 0
+        _, geometry = union_by_group(
+            np.concatenate([quads[has_area], np.tile(footprints[targets[from_walls]], T)]),
+            np.concatenate([codes[has_area], np.arange(T*k)]))
+        shadows[:, from_walls] = geometry.reshape((T, k))
+    return shadows
+
+
+def walls_facing_away(culling, sunPosition):
+    '''
+    Select the walls facing away from the sun.
+
+    For a closed building outline, the shadows of the walls facing the sun are covered by the
+    outline itself and the shadows of the walls facing away from the sun, so they can be skipped.
+
+    Parameters
+    ----------
+    culling : tuple
+        Outward normal of each wall(shape = [n,2]) and whether each wall can be skipped(shape = [n]).
+    sunPosition : dict
+        The position of the sun. The keys are 'azimuth' and 'altitude'.
+
+    Returns
+    -------
+    facing : numpy.ndarray
+        Whether each wall should be kept, shape = [n]
+    '''
+    normals, cullable = culling
+    # direction of the shadow on the ground
+    direction = np.array([np.sin(sunPosition['azimuth']),
+                          np.cos(sunPosition['azimuth'])])
+    return (normals @ direction > 0) | (~cullable)
+
+
+def shadow_reach_pairs(tree, heights, sunPosition, bounds=None):
+    '''
+    Find the building pairs where one building can cast shadow on the roof of the other.
+
+    The longest shadow a building can cast on a roof is `(height - roof height) / tan(altitude)`.
+    The bounding box of each roof is expanded towards the sun by the longest possible shadow,
+    and only the footprints in this window are tested.
+
+    Parameters
+    ----------
+    tree : shapely.STRtree
+        Spatial index of the building footprints(projected coordinates, meter).
+    heights : numpy.ndarray
+        Height of each building, in the same order as the footprints in the tree.
+    sunPosition : dict
+        The position of the sun. The keys are 'azimuth' and 'altitude'.
+    bounds : numpy.ndarray
+        Bounds of the footprints, shape = [n,4]. Obtained from the tree if not given.
+
+    Returns
+    -------
+    roof : numpy.ndarray
+        Positional index of the building receiving the shadow on its roof.
+    occluder : numpy.ndarray
+        Positional index of the building casting the shadow.
+    '''
+    heights = np.asarray(heights, dtype=float)
+    if len(heights) == 0:
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+    # shadow offset per meter of height
+    direction = np.array([np.sin(sunPosition['azimuth']),
+                          np.cos(sunPosition['azimuth'])])/np.tan(sunPosition['altitude'])
+    if bounds is None:
+        bounds = shapely.bounds(tree.geometries)
+
+    def sweep(bounds, offset):
+        return np.column_stack([
+            np.minimum(bounds[:, 0], bounds[:, 0]+offset[:, 0]),
+            np.minimum(bounds[:, 1], bounds[:, 1]+offset[:, 1]),
+            np.maximum(bounds[:, 2], bounds[:, 2]+offset[:, 0]),
+            np.maximum(bounds[:, 3], bounds[:, 3]+offset[:, 1])])
+
+    # query window: the roof swept back towards the sun by the longest possible shadow
+    reach = (heights.max()-heights).reshape((-1, 1))*direction
+    windows = sweep(bounds, -reach)
+    roof, occluder = tree.query(shapely.box(
+        windows[:, 0], windows[:, 1], windows[:, 2], windows[:, 3]))
+    higher = heights[occluder] > heights[roof]
+    roof, occluder = roof[higher], occluder[higher]
+
+    # refine with the actual reach of each occluder at the height of the roof
+    reach = (heights[occluder]-heights[roof]).reshape((-1, 1))*direction
+    shadow_bounds = sweep(bounds[occluder], reach)
+    roof_bounds = bounds[roof]
+    overlap = (shadow_bounds[:, 0] <= roof_bounds[:, 2]) & (shadow_bounds[:, 2] >= roof_bounds[:, 0]) & \
+        (shadow_bounds[:, 1] <= roof_bounds[:, 3]) & (shadow_bounds[:, 3] >= roof_bounds[:, 1])
+    return roof[overlap], occluder[overlap]
+
+
+def _subtract_footprints(geometry, footprints, tree):
+    '''
+    Subtract the footprints intersecting each geometry, using the spatial index of the footprints.
+    '''
+    geometry = np.array(geometry, dtype=object)
+    footprints = np.asarray(footprints)
+    row, other = tree.query(geometry, predicate='intersects')
+    rows, cover = union_by_group(footprints[other], row)
+    geometry[rows] = shapely.difference(geometry[rows], cover)
+    return geometry
+
+
+def _roof_shadows(prepared, sunPosition, cull_walls, chunks=None, executor=None):
+    '''
+    Calculate the shadows on the roofs at one sun position.
+
+    Instead of recomputing the shadows of all higher walls at every roof height,
+    the occluder/roof pairs within shadow reach are found once, and the shadow of
+    each occluder is computed only at the heights of the roofs it can reach.
+    The shadow of an occluder at a given height is shared by all the roofs at that height.
+
+    The pairs are split by the chunk of the roof, so that the occluders of a roof
+    may come from any chunk.
+    '''
+    heights, building_id = prepared.heights, prepared.building_id
+
+    # 屋顶只可能被阴影范围内的更高建筑遮挡
+    roof, occluder = shadow_reach_pairs(prepared.tree, heights, sunPosition, prepared.bounds)
+    if len(roof) == 0:
+        return gpd.GeoDataFrame(columns=['height', 'building_id', 'geometry', 'type'],
+                                geometry='geometry')
+
+    # 按屋顶所在的分块拆分配对
+    if chunks is None:
+        parts = [np.arange(len(roof))]
+    else:
+        chunk_of = np.empty(len(prepared), dtype=int)
+        for i, chunk in enumerate(chunks):
+            chunk_of[chunk] = i
+        order = np.argsort(chunk_of[roof], kind='stable')
+        parts = np.split(order, np.searchsorted(chunk_of[roof][order], np.arange(1, len(chunks))))
+        parts = [part for part in parts if len(part) > 0]
+    results = _map_chunks(lambda part: _roof_shade(
+        prepared, roof[part], occluder[part], sunPosition, cull_walls), parts, executor)
+    roofs = np.concatenate([result[0] for result in results])
+    shade = np.concatenate([result[1] for result in results])
+    order = np.argsort(roofs)
+    roofs, shade = roofs[order], shade[order]
+
+    # 只保留面状的阴影
+    collection = shapely.get_type_id(shade) == 7
+    shade[collection] = shapely.buffer(shade[collection], 0)
+    keep = shapely.area(shade) > 0
+
+    roof_shadow = gpd.GeoDataFrame({'height': heights[roofs][keep],
+                                    'building_id': building_id[roofs][keep]},
+                                   geometry=list(shade[keep]))
+    roof_shadow = roof_shadow.sort_values(by=['height', 'building_id'])
+    roof_shadow['type'] = 'roof'
+    return roof_shadow
+
+
+def _roof_shade(prepared, roof, occluder, sunPosition, cull_walls):
+    '''
+    Calculate the shade on the roofs of the given occluder/roof pairs.
+
+    Returns the positional index of the shaded roofs and their shade.
+    '''
+    footprints, heights, tree = prepared.footprints, prepared.heights, prepared.tree
+
+    # 每个遮挡建筑在每个屋顶高度只计算一次阴影
+    levels, level_of = np.unique(heights, return_inverse=True)
+    combos, combo_of_pair = np.unique(
+        occluder*len(levels)+level_of[roof], return_inverse=True)
+    combo_occluder = combos//len(levels)
+    combo_level = levels[combos % len(levels)]
+
+    occluder_shadow = sweep_shadows(
+        prepared, combo_occluder, heights[combo_occluder]-combo_level, sunPosition, cull_walls)
+
+    # 与屋顶做交集
+    occluder_shadow = occluder_shadow[combo_of_pair]
+    reached = shapely.intersects(occluder_shadow, footprints[roof])
+    roofs, shade = union_by_group(occluder_shadow[reached], roof[reached])
+    shade = shapely.intersection(footprints[roofs], shade)
+
+    # 再减去这个高度以上的建筑
+    roof_row, over = tree.query(footprints[roofs], predicate='intersects')
+    higher = heights[over] > heights[roofs[roof_row]]
+    covered, cover = union_by_group(footprints[over[higher]], roof_row[higher])
+    shade[covered] = shapely.difference(shade[covered], cover)
+    return roofs, shade
+
+
+def calPointLightShadow_vector(shape, shapeHeight, pointLight, max_distance=None):
     '''
     calculate shadow for a point light
     
@@ -252,7 +802,12 @@ def calPointLightShadow_vector(shape, shapeHeight, pointLight):
     shapeHeight : numpy.array
         height of building, shape = [n,1], n is the number of buildings
     pointLight : dict
-        point light, pointLight = {'position':[lon,lat,height]}
+        point light, pointLight = {'position':[lon,lat,height]}.
+        The position can also be given for each wall, with shape = [n,3]
+    max_distance : number
+        Maximum shadow distance from the light, in the unit of the coordinates.
+        If given, the shadows are only projected far enough to cover the disc of this radius around the light,
+        instead of the fixed scale used for the walls taller than the light.
     
     Returns
     -------
@@ -263,19 +818,36 @@ def calPointLightShadow_vector(shape, shapeHeight, pointLight):
     # 输入的shape是一个矩阵（n*2*2) n个建筑物面，每个建筑有2个点，每个点有三个维度
     # shapeHeight(n) 每一栋建筑的高度都是一样的
     n = np.shape(shape)[0]
-    pointLightPosition = pointLight['position']  # [lon,lat,height]
+    pointLightPosition = np.asarray(
+        pointLight['position'], dtype=float)  # [lon,lat,height] or [n,3]
 
     # 高度比
-    diff = pointLightPosition[2] - shapeHeight
+    diff = np.broadcast_to(pointLightPosition[..., 2] - shapeHeight, (n,))
+    shapeHeight = np.broadcast_to(shapeHeight, (n,))
     scale = np.zeros(n)
     scale[diff != 0] = shapeHeight[diff != 0]/(diff[diff != 0])
-    scale[scale <= 0] = 10  # n
+    vertexToLightVector = shape - pointLightPosition[..., None, 0:2]  # n,2,2
+    if max_distance is None:
+        scale[scale <= 0] = 10  # n
+    else:
+        # 墙高于光源时阴影无限长，只需投影到圆盘之外
+        # 阴影远边到光源的距离不小于 min(d0,d1)*(1+scale)*cos(θ/2)
+        distance = np.linalg.norm(vertexToLightVector, axis=2)
+        cos_angle = np.zeros(n)
+        np.divide((vertexToLightVector[:, 0, :]*vertexToLightVector[:, 1, :]).sum(axis=1),
+                  distance.prod(axis=1), out=cos_angle, where=distance.prod(axis=1) > 0)
+        cos_half = np.maximum(np.sqrt(np.clip((1+cos_angle)/2, 0, 1)), 1e-3)
+        bounded = np.zeros(n)
+        np.divide(max_distance/cos_half, distance.min(axis=1), out=bounded,
+                  where=distance.min(axis=1) > 0)
+        bounded = np.maximum(bounded-1, 0)
+        scale[scale <= 0] = bounded[scale <= 0]
+        scale = np.minimum(scale, bounded)
     scale = scale.reshape((n, 1))
 
     shadowShape = np.zeros((n, 5, 2))
 
     shadowShape[:, 0:2, :] += shape  # 前两个点不变
-    vertexToLightVector = shape - pointLightPosition[0:2]  # n,2,2
 
     shadowShape[:, 2, :] = shape[:, 1, :] + \
         vertexToLightVector[:, 1, :]*scale  # [n,2,2] = [n,2,2]+[n,2,2]*n
@@ -292,16 +864,20 @@ def bdshadow_pointlight(buildings,
                         pointheight,
                         merge=True,
                         height='height',
-                        ground=0):
+                        ground=0,
+                        max_distance=None,
+                        grid_size=None,
+                        workers=None):
     '''
     Calculate the sunlight shadow of the buildings.
 
     Parameters
     --------------------
-    buildings : GeoDataFrame
-        Buildings. coordinate system should be WGS84
+    buildings : GeoDataFrame or PreparedBuildings
+        Buildings. coordinate system should be WGS84, or a projected coordinate system in meters.
     pointlon,pointlat,pointheight : float
-        Point light coordinates and height(meter).
+        Point light coordinates, in the coordinate system of the buildings, and height(meter).
+        The height is measured from the same level as the building heights, so that both are reduced by `ground`.
     date : datetime
         Datetime
     merge : bool
@@ -309,7 +885,15 @@ def bdshadow_pointlight(buildings,
     height : string
         Column name of building height(meter).
     ground : number
-        Height of the ground
+        Height of the ground, subtracted from the building and light heights.
+    max_distance : number
+        Maximum shadow distance(meter) from the light.
+        Walls farther than this are skipped and the wall shadows are clipped to the disc of this radius around the light.
+    grid_size : float
+        Precision of the output coordinates, see `bdshadow_sunlight`.
+    workers : int
+        Number of threads used to calculate the shadows, on spatially coherent chunks of the buildings.
+        The result does not depend on the number of workers. If None, all the buildings are calculated in one batch.
     
     Returns
     ----------
@@ -317,52 +901,214 @@ def bdshadow_pointlight(buildings,
         Building shadow
     '''
 
-    building = buildings.copy()
-
-    building[height] -= ground
-    building = building[building[height] > 0]
+    prepared = prepare_buildings(buildings, height=height, ground=ground)
 
-    if len(building) == 0:
+    if len(prepared) == 0:
         walls = gpd.GeoDataFrame()
         walls['geometry'] = []
         walls['building_id'] = []
         return walls
-    # building to walls
-    buildingshadow = building.copy()
-
-    a = buildingshadow['geometry'].apply(lambda r: list(r.exterior.coords))  #裸格式的几何
-    buildingshadow['wall'] = a  #
-    #print(a[0])
-    buildingshadow = buildingshadow.set_index(['building_id']) #设置阴影所对应的id
-    a = buildingshadow.apply(lambda x: pd.Series(x['wall']), axis=1).unstack()  #压缩为一个数组
-    walls = a[- a.isnull()].reset_index().sort_values(
-        by=['building_id', 'level_0'])  #重新排序
-    walls = pd.merge(walls, buildingshadow['height'].reset_index())#与高度融合
-    
-    walls['x1'] = walls[0].apply(lambda r: r[0])  #
-    walls['y1'] = walls[0].apply(lambda r: r[1])
-    walls['x2'] = walls['x1'].shift(-1)  #向量中的序号全部向前提了一个
-    walls['y2'] = walls['y1'].shift(-1)
-    walls = walls[walls['building_id'] == walls['building_id'].shift(-1)]
-    walls = walls[['x1', 'y1', 'x2', 'y2', 'building_id', 'height']]
-    walls['wall'] = walls.apply(lambda r: [[r['x1'], r['y1']],
-                                           [r['x2'], r['y2']]], axis=1)
-    walls_shape = np.array(list(walls['wall']))
+    projection = prepared.projection
+    building = gpd.GeoDataFrame({'building_id': prepared.building_id},
+                                geometry=prepared.footprints)
 
+    light = projection.forward([pointlon, pointlat])
     # Create point light
-    pointLightPosition = {'position': [pointlon, pointlat, pointheight]}
-    # calculate shadow for walls
+    pointLightPosition = {'position': [light[0], light[1], pointheight-prepared.ground]}
+
+    def run(chunk):
+        # walls of the buildings
+        wall_pos, _ = _gather_walls(prepared.wall_offsets, chunk)
+        walls_shape = prepared.walls[wall_pos]
+        if max_distance is not None:
+            near = _segment_distance(walls_shape, np.broadcast_to(light, (len(walls_shape), 2))) <= max_distance
+            wall_pos, walls_shape = wall_pos[near], walls_shape[near]
+        walls_height = prepared.heights[prepared.wall_index[wall_pos]]
+        walls_id = prepared.building_id[prepared.wall_index[wall_pos]]
+        # calculate shadow for walls
+        shadowShape = calPointLightShadow_vector(
+            walls_shape, walls_height, pointLightPosition, max_distance)
+        quads = _clip_shadows(shadowShape, np.broadcast_to(light, (len(shadowShape), 2)), max_distance)
+        if merge:
+            shadows = merge_wall_shadows(quads, walls_id, building.iloc[chunk])
+            return shadows['building_id'].values, shadows
+        return wall_pos, gpd.GeoDataFrame({'building_id': walls_id}, geometry=quads)
+
+    if workers is None:
+        _, shadows = run(np.arange(len(prepared)))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = _map_chunks(run, spatial_chunks(prepared.footprints, 4*workers), executor)
+        # 恢复与单批计算相同的顺序
+        order = np.argsort(np.concatenate([result[0] for result in results]), kind='stable')
+        shadows = pd.concat([result[1] for result in results]).iloc[order].reset_index(drop=True)
+
+    if merge:
+        shadows['geometry'] = projection.inverse_geometry(shadows['geometry'])
+        shadows = shadows.set_crs(prepared.crs, allow_override=True)
+    else:
+        walls = gpd.GeoDataFrame({'building_id': shadows['building_id'].values},
+                                 geometry=projection.inverse_geometry(shadows['geometry']), crs=prepared.crs)
+        shadows = pd.concat([walls, prepared.buildings])
+    return _snap_shadows(shadows, grid_size)
+
+
+def bdshadow_pointlights(buildings,
+                         lights,
+                         radius=None,
+                         max_distance=None,
+                         merge=True,
+                         height='height',
+                         ground=0,
+                         pointlon='lon',
+                         pointlat='lat',
+                         pointheight='height',
+                         pointid='id',
+                         chunksize=64,
+                         workers=None,
+                         grid_size=None):
+    '''
+    Calculate the shadows of the buildings for many point lights.
+
+    The walls are extracted once and the shadows of all light/wall pairs are calculated in batches.
+
+    Parameters
+    --------------------
+    buildings : GeoDataFrame or PreparedBuildings
+        Buildings. coordinate system should be WGS84, or a projected coordinate system in meters.
+    lights : DataFrame
+        Point lights, with the columns of longitude, latitude, height(meter) and id.
+        The coordinates are in the coordinate system of the buildings.
+    radius : number
+        Influence radius(meter) of the lights. Only the walls within this distance of a light are considered.
+        If None, all the walls are considered for every light.
+    max_distance : number
+        Maximum shadow distance(meter) from the light, the wall shadows are clipped to the disc of this radius around the light.
+        If None, the shadows are clipped to the influence radius.
+    merge : bool
+        Whether to merge the wall shadows into the building shadows
+    height : string
+        Column name of building height(meter).
+    ground : number
+        Height of the ground, subtracted from the building and light heights.
+    pointlon,pointlat,pointheight,pointid : string
+        Column names of the light longitude, latitude, height(meter) and id.
+        The light height is measured from the same level as the building heights, see `bdshadow_pointlight`.
+    chunksize : int
+        Number of lights calculated in one batch.
+    workers : int
+        Number of threads used to calculate the batches. If None, the batches are calculated in sequence.
+    grid_size : float
+        Precision of the output coordinates, see `bdshadow_sunlight`.
+
+    Returns
+    ----------
+    shadows : GeoDataFrame
+        Building shadow of each light, with the columns of light_id, building_id and geometry
+    '''
+
+    prepared = prepare_buildings(buildings, height=height, ground=ground)
+    lights = lights.reset_index(drop=True)
+
+    if (len(prepared) == 0) | (len(lights) == 0):
+        return gpd.GeoDataFrame({'light_id': [], 'building_id': []},
+                                geometry=[], crs=prepared.crs)
+
+    # 投影到米制坐标后计算
+    projection = prepared.projection
+    positions = np.column_stack([
+        projection.forward(lights[[pointlon, pointlat]].values),
+        lights[pointheight].values.astype(float)-prepared.ground])
+    if max_distance is None:
+        max_distance = radius
+    elif radius is not None:
+        radius = min(radius, max_distance)
+    else:
+        radius = max_distance
+    tree = prepared.tree if radius is not None else None
+
+    chunks = [np.arange(start, min(start+chunksize, len(lights)))
+              for start in range(0, len(lights), chunksize)]
+
+    def run(chunk):
+        return _pointlight_chunk(chunk, positions, prepared, tree, radius, max_distance, merge)
+    if workers is None:
+        results = [run(chunk) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(run, chunks))
+
+    light_pos = np.concatenate([result[0] for result in results])
+    building_pos = np.concatenate([result[1] for result in results])
+    geometry = np.concatenate([result[2] for result in results])
+    shadows = gpd.GeoDataFrame({
+        'light_id': lights[pointid].values[light_pos],
+        'building_id': prepared.building_id[building_pos]},
+        geometry=projection.inverse_geometry(geometry), crs=prepared.crs)
+    return _snap_shadows(shadows, grid_size)
+
+
+def _pointlight_chunk(chunk, positions, prepared, tree, radius, max_distance, merge):
+    '''
+    Calculate the shadows of a batch of point lights, in projected coordinates.
+
+    Returns the positional index of the light and the building, and the shadow geometry.
+    '''
+    walls_shape, footprints = prepared.walls, prepared.footprints
+    # 光源与建筑的配对
+    if tree is None:
+        pair_light = np.repeat(chunk, len(footprints))
+        pair_building = np.tile(np.arange(len(footprints)), len(chunk))
+    else:
+        pair_light, pair_building = tree.query(
+            shapely.points(positions[chunk, :2]), predicate='dwithin', distance=radius)
+        order = np.lexsort([pair_building, pair_light])
+        pair_light, pair_building = chunk[pair_light[order]], pair_building[order]
+
+    # 配对中的墙
+    wall_pos, owner = _gather_walls(prepared.wall_offsets, pair_building)
+    position = positions[pair_light[owner]]
+    if radius is not None:
+        near = _segment_distance(walls_shape[wall_pos], position[:, :2]) <= radius
+        wall_pos, owner, position = wall_pos[near], owner[near], position[near]
     shadowShape = calPointLightShadow_vector(
-        walls_shape, walls['height'].values, pointLightPosition)
+        walls_shape[wall_pos], prepared.heights[prepared.wall_index[wall_pos]], {'position': position},
+        max_distance)
+    quads = _clip_shadows(shadowShape, position[:, :2], max_distance)
+    has_area = shapely.area(quads) > 0
+    quads, owner = quads[has_area], owner[has_area]
 
-    walls['geometry'] = list(shadowShape)  #阴影存储
-    walls['geometry'] = walls['geometry'].apply(lambda r: Polygon(r))  #将numpy转换成polygon形式
-    walls = gpd.GeoDataFrame(walls)  #8列 x1 ， y1 ，x2 ， y2 ， building_id ， height ，  wall ，shadow 
-    wallsBuilding = pd.concat([walls, building]) #
-    #print(wallsBuilding)
+    geometry = np.concatenate([quads, footprints[pair_building]])
+    codes = np.concatenate([owner, np.arange(len(pair_light))])
     if merge:
-        wallsBuilding = wallsBuilding.groupby(['building_id'])['geometry'].apply(
-            lambda df: MultiPolygon(list(df)).buffer(0)).reset_index()
-        #print(wallsBuilding)
-    shadows=wallsBuilding
-    return shadows
+        _, shadows = union_by_group(geometry, codes)
+        return pair_light, pair_building, shadows
+    order = np.argsort(codes, kind='stable')
+    return pair_light[codes[order]], pair_building[codes[order]], geometry[order]
+
+
+def _clip_shadows(shadowShape, centers, max_distance):
+    '''
+    Build the wall shadow polygons and clip them to the disc of max_distance around their light.
+
+    Only the shadows reaching out of the disc are clipped.
+    '''
+    quads = shapely.polygons(shadowShape)
+    if max_distance is None:
+        return quads
+    far = (np.linalg.norm(shadowShape-centers[:, None, :], axis=2) > max_distance).any(axis=1)
+    quads[far] = shapely.intersection(
+        quads[far], shapely.buffer(shapely.points(centers[far]), max_distance))
+    return quads
+
+
+def _segment_distance(segments, points):
+    '''
+    Distance from each point to the corresponding segment, segments shape = [n,2,2], points shape = [n,2].
+    '''
+    start, vector = segments[:, 0, :], segments[:, 1, :]-segments[:, 0, :]
+    length2 = (vector**2).sum(axis=1)
+    t = np.zeros(len(segments))
+    np.divide(((points-start)*vector).sum(axis=1), length2, out=t, where=length2 > 0)
+    nearest = start+vector*np.clip(t, 0, 1).reshape((-1, 1))
+    return np.sqrt(((points-nearest)**2).sum(axis=1))
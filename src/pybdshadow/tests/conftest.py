@@ -0,0 +1,27 @@
+import pytest
+import geopandas as gpd
+import pybdshadow
+from shapely.geometry import Polygon
+
+
+@pytest.fixture
+def buildings():
+    '''
+    Two preprocessed buildings in WGS84, a concave one of 42 m and a convex one of 9 m.
+    '''
+    buildings = gpd.GeoDataFrame({
+        'height': [42, 9],
+        'geometry': [
+            Polygon([(139.698311, 35.533796),
+                     (139.698311, 35.533642),
+                     (139.699075, 35.533637),
+                     (139.699079, 35.53417),
+                     (139.698891, 35.53417),
+                     (139.698888, 35.533794),
+                     (139.698311, 35.533796)]),
+            Polygon([(139.69799, 35.534175),
+                     (139.697988, 35.53389),
+                     (139.698814, 35.533885),
+                     (139.698816, 35.534171),
+                     (139.69799, 35.534175)])]}, crs='epsg:4326')
+    return pybdshadow.bd_preprocess(buildings)
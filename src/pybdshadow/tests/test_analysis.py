@@ -1,40 +1,85 @@
 import pybdshadow
+import pytest
+import numpy as np
 import geopandas as gpd
-from shapely.geometry import Polygon
+from shapely.geometry import box
 
 
 class Testanalysis:
-    def test_analysis(self):
-        buildings = gpd.GeoDataFrame({
-            'height': [42, 9],
-            'geometry': [
-                Polygon([(139.698311, 35.533796),
-                        (139.698311,
-                            35.533642),
-                        (139.699075,
-                            35.533637),
-                        (139.699079,
-                            35.53417),
-                        (139.698891,
-                            35.53417),
-                        (139.698888,
-                            35.533794),
-                        (139.698311, 35.533796)]),
-                Polygon([(139.69799, 35.534175),
-                        (139.697988, 35.53389),
-                        (139.698814, 35.533885),
-                        (139.698816, 35.534171),
-                        (139.69799, 35.534175)])]})
-
-        buildings = pybdshadow.bd_preprocess(buildings)
+    def test_analysis(self, buildings):
         #分析
         date = '2022-01-01'
         shadows = pybdshadow.cal_sunshadows(buildings,dates = [date],precision=3600)
         bdgrids = pybdshadow.cal_shadowcoverage(shadows,buildings,precision = 3600,accuracy=2)
         assert len(bdgrids)==1185
+
+        # 多进程计算的结果与单进程相同
+        pooled = pybdshadow.cal_sunshadows(buildings,dates = [date],precision=3600,n_jobs=2)
+        assert list(pooled['date']) == list(shadows['date'])
+        assert pooled.area.sum() == shadows.area.sum()
+
+        # 逐个时刻计算
+        stream = pybdshadow.iter_sunshadows(buildings,dates = [date],precision=3600)
+        streamed = pybdshadow.cal_shadowcoverage(stream,buildings,precision = 3600,accuracy=2)
+        assert list(streamed['time']) == list(bdgrids['time'])
+        dates = [datetime for datetime, _ in pybdshadow.iter_sunshadows(
+            buildings,dates = [date],precision=3600,n_jobs=2)]
+        assert dates == list(shadows['date'].unique())
         
+        # 栅格计算：格网中心被阴影覆盖才计数
+        shadow_time, transform = pybdshadow.cal_shadowcoverage_raster(
+            shadows,buildings,precision = 3600,accuracy=2)
+        rastergrids = pybdshadow.raster_to_grids(shadow_time, transform, precision = 3600)
+        assert len(rastergrids) == (~np.isnan(shadow_time)).sum()
+        assert 0 < rastergrids['time'].sum() <= bdgrids.drop_duplicates(['LONCOL','LATCOL'])['time'].sum()
+        rastergrids = pybdshadow.cal_shadowcoverage(
+            shadows,buildings,precision = 3600,accuracy=2,method='raster')
+        assert rastergrids['time'].sum() == np.nansum(shadow_time)
+
         grids = pybdshadow.cal_sunshine(buildings)
         assert len(grids)==1882
                                  
         sunshine = pybdshadow.cal_sunshine(buildings,accuracy='vector')
-        sunshine = pybdshadow.cal_sunshine(buildings,accuracy='vector',roof = True)
\ No newline at end of file
+        sunshine = pybdshadow.cal_sunshine(buildings,accuracy='vector',roof = True)
+
+    def test_shadow_cache(self, buildings, tmp_path):
+        pytest.importorskip('pyarrow')
+        cache = pybdshadow.ShadowCache(str(tmp_path))
+        shadows = pybdshadow.cal_sunshadows(buildings, dates=['2022-01-01'], cache=cache)
+        assert len(list(tmp_path.iterdir())) == shadows['date'].nunique()
+        # 第二次运行从缓存读取
+        cached = pybdshadow.cal_sunshadows(buildings, dates=['2022-01-01'], cache=str(tmp_path))
+        assert list(cached['date']) == list(shadows['date'])
+        assert cached.geom_equals(shadows).all()
+        # 超出大小时清除最久未用的文件
+        cache.max_size = cache.size()//2
+        cache.evict()
+        assert 0 < cache.size() <= cache.max_size
+
+    def test_shadow_cache_eviction(self, buildings, tmp_path):
+        pytest.importorskip('pyarrow')
+        # 缓存只能保留一个时刻
+        cache = pybdshadow.ShadowCache(str(tmp_path), max_size=1)
+        shadows = pybdshadow.cal_sunshadows(buildings, dates=['2022-01-01'], cache=cache)
+        assert len(list(tmp_path.iterdir())) == 1
+        last = list(tmp_path.iterdir())[0]
+        # 最后一个时刻在读取前被前面的写入清除，重新计算并写回缓存
+        cached = pybdshadow.cal_sunshadows(buildings, dates=['2022-01-01'], cache=cache)
+        assert list(cached['date']) == list(shadows['date'])
+        assert cached.geom_equals(shadows).all()
+        assert list(tmp_path.iterdir()) == [last]
+
+    def test_shadow_cache_obstacles(self, tmp_path):
+        pytest.importorskip('pyarrow')
+        # 北侧的矮建筑低于地面，不产生阴影，但include_building=False时从阴影中扣除
+        tall = box(139.6980, 35.5330, 139.6985, 35.5334)
+        low = box(139.6980, 35.5335, 139.6985, 35.5339)
+        alone = pybdshadow.prepare_buildings(pybdshadow.bd_preprocess(
+            gpd.GeoDataFrame({'height': [42]}, geometry=[tall], crs='EPSG:4326')), ground=10)
+        neighbour = pybdshadow.prepare_buildings(pybdshadow.bd_preprocess(
+            gpd.GeoDataFrame({'height': [42, 5]}, geometry=[tall, low], crs='EPSG:4326')), ground=10)
+        assert pybdshadow.buildings_fingerprint(alone) != pybdshadow.buildings_fingerprint(neighbour)
+        pybdshadow.cal_sunshadows(alone, include_building=False, cache=str(tmp_path))
+        cached = pybdshadow.cal_sunshadows(neighbour, include_building=False, cache=str(tmp_path))
+        truth = pybdshadow.cal_sunshadows(neighbour, include_building=False)
+        assert np.allclose(cached.to_crs(32654).area.values, truth.to_crs(32654).area.values)
@@ -1,46 +1,68 @@
 import pybdshadow
 import numpy as np
+import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Polygon
 
 
 class Testpointlightshadow:
-    def test_bdshadow_pointlight(self):
-
-        buildings = gpd.GeoDataFrame({
-            'height': [42, 9],
-            'geometry': [
-                Polygon([(139.698311, 35.533796),
-                        (139.698311,
-                            35.533642),
-                        (139.699075,
-                            35.533637),
-                        (139.699079,
-                            35.53417),
-                        (139.698891,
-                            35.53417),
-                        (139.698888,
-                            35.533794),
-                        (139.698311, 35.533796)]),
-                Polygon([(139.69799, 35.534175),
-                        (139.697988, 35.53389),
-                        (139.698814, 35.533885),
-                        (139.698816, 35.534171),
-                        (139.69799, 35.534175)])]})
-
-        buildings = pybdshadow.bd_preprocess(buildings)
-
+    def test_bdshadow_pointlight(self, buildings):
         pointlon,pointlat,pointheight = [139.69799, 35.534175,100]
         #Calculate building shadow for point light
         shadows = pybdshadow.bdshadow_pointlight(buildings,pointlon,pointlat,pointheight)
         result = list(shadows['geometry'].iloc[0].exterior.coords)
-        truth = [(139.698311, 35.533642),
-        (139.698311, 35.533796),
+        truth = [(139.698311, 35.533796),
         (139.698888, 35.533794),
         (139.698891, 35.53417),
         (139.699079, 35.53417),
         (139.69986758620692, 35.53416637931035),
         (139.69986068965517, 35.533247413793106),
         (139.69854344827584, 35.53325603448276),
-        (139.698311, 35.533642)]
-        assert np.allclose(result,truth)
\ No newline at end of file
+        (139.698311, 35.533642),
+        (139.698311, 35.533796)]
+        assert np.allclose(result,truth)
+
+    def test_bdshadow_pointlights(self, buildings):
+        lights = pd.DataFrame({'id': ['a', 'b'],
+                               'lon': [139.69799, 139.6985],
+                               'lat': [35.534175, 35.5335],
+                               'height': [100, 60]})
+        shadows = pybdshadow.bdshadow_pointlights(buildings, lights, workers=2, chunksize=1)
+        assert list(shadows['light_id']) == ['a', 'a', 'b', 'b']
+        for light in lights.itertuples():
+            single = pybdshadow.bdshadow_pointlight(
+                buildings, light.lon, light.lat, light.height)
+            batch = shadows[shadows['light_id'] == light.id]
+            assert np.allclose(batch.area.values, single.area.values, rtol=1e-4)
+        near = pybdshadow.bdshadow_pointlights(buildings, lights, radius=20)
+        assert len(near) < len(shadows)
+
+        # 光源与建筑高度都从ground起算
+        raised = pybdshadow.bdshadow_pointlights(buildings, lights, ground=10)
+        lowered = buildings.copy()
+        lowered['height'] -= 10
+        shifted = lights.assign(height=lights['height']-10)
+        truth = pybdshadow.bdshadow_pointlights(lowered, shifted)
+        assert np.allclose(raised.area.values, truth.area.values)
+        for light in lights.itertuples():
+            single = pybdshadow.bdshadow_pointlight(
+                buildings, light.lon, light.lat, light.height, ground=10)
+            batch = raised[raised['light_id'] == light.id]
+            assert np.allclose(batch.area.values, single.area.values, rtol=1e-4)
+
+    def test_bdshadow_pointlight_max_distance(self, buildings):
+        # the light is lower than the first building, its shadow is clipped by the disc
+        shadows = pybdshadow.bdshadow_pointlight(
+            buildings, 139.6985, 35.5335, 20, max_distance=100)
+        disc = gpd.GeoSeries(gpd.points_from_xy([139.6985], [35.5335]),
+                             crs='epsg:4326').to_crs('epsg:3857').buffer(100*1.25)
+        reach = shadows.to_crs('epsg:3857').union_all().difference(disc.iloc[0])
+        assert reach.area < 1e-6
+
+    def test_bdshadow_pointlight_workers(self, buildings):
+        for merge in [True, False]:
+            truth = pybdshadow.bdshadow_pointlight(
+                buildings, 139.713319, 35.552040, 200, merge=merge)
+            shadows = pybdshadow.bdshadow_pointlight(
+                buildings, 139.713319, 35.552040, 200, merge=merge, workers=2)
+            assert list(shadows['building_id']) == list(truth['building_id'])
+            assert np.allclose(shadows.area.values, truth.area.values)
@@ -0,0 +1,113 @@
+import pybdshadow
+import numpy as np
+import pandas as pd
+import shapely
+import geopandas as gpd
+from shapely.geometry import Polygon, MultiPolygon, box
+from pybdshadow.preprocess import gdf_difference, gdf_intersect
+
+
+class Testpreprocess:
+    def test_bd_preprocess(self):
+        square = Polygon([(0, 0), (1, 0), (1, 1), (0, 1)])
+        buildings = gpd.GeoDataFrame({
+            'height': [10, 'x', 20, -5],
+            'name': ['a', 'b', 'c', 'd'],
+            'geometry': [square,
+                         square,
+                         MultiPolygon([Polygon([(2, 0), (3, 0), (3, 1), (2, 1)]),
+                                       Polygon([(4, 0), (5, 0), (5, 1), (4, 1)])]),
+                         square]})
+        result = pybdshadow.bd_preprocess(buildings, height='height')
+        # the parts of the multipolygons come first
+        assert list(result['name']) == ['c', 'c', 'a']
+        assert list(result['building_id']) == [0, 1, 2]
+        assert list(result['height']) == [20, 20, 10]
+        chunked = pybdshadow.bd_preprocess(buildings, height='height', n_jobs=2, chunksize=2)
+        assert chunked.drop(columns='geometry').equals(result.drop(columns='geometry'))
+        assert chunked.geom_equals(result).all()
+
+    def test_gdf_overlay(self):
+        gdf_a = gpd.GeoDataFrame({
+            'building_id': [3, 1, 2, 0],
+            'height': [10, 20, 30, 40],
+            'geometry': [box(0, 0, 2, 2), box(10, 10, 12, 12),
+                         box(5, 5, 7, 7), box(20, 20, 21, 21)]},
+            index=[7, 8, 9, 10])
+        gdf_b = gpd.GeoDataFrame(
+            geometry=[box(1, 1, 3, 3), box(6, 6, 8, 8), box(1.5, 0, 3, 1)], crs='EPSG:3857')
+
+        # the intersected rows come first sorted by building_id, then the untouched rows in order
+        difference = gdf_difference(gdf_a, gdf_b)
+        assert list(difference.columns) == ['building_id', 'height', 'geometry']
+        assert list(difference['building_id']) == [2, 3, 1, 0]
+        assert list(difference['height']) == [30, 10, 20, 40]
+        assert list(difference.index) == [0, 1, 1, 3]
+        assert list(difference.area) == [3, 2.5, 4, 1]
+        assert difference.iloc[2:].geom_equals(gdf_a.iloc[[1, 3]].set_index(difference.index[2:])).all()
+        assert difference.crs == gdf_b.crs
+
+        intersection = gdf_intersect(gdf_a, gdf_b)
+        assert list(intersection.columns) == ['building_id', 'height', 'geometry']
+        assert list(intersection['building_id']) == [2, 3]
+        assert list(intersection.index) == [0, 1]
+        assert list(intersection.area) == [1, 1.5]
+        assert intersection.crs == gdf_b.crs
+
+        # the result takes the crs of gdf_b, also for the untouched rows
+        gdf_a = gdf_a.set_crs('EPSG:4326')
+        assert gdf_difference(gdf_a, gdf_b).crs == gdf_b.crs
+        assert gdf_intersect(gdf_a, gdf_b).crs == gdf_b.crs
+        assert gdf_difference(gdf_a, gdf_b.set_crs(None, allow_override=True)).crs is None
+
+    def test_bin_heights(self):
+        heights = np.array([0.4, 9.02, 41.7, 42.3])
+        assert np.allclose(pybdshadow.bin_heights(heights, 1), [0, 9, 42, 42])
+        assert np.allclose(pybdshadow.bin_heights(heights, 1, 'ceil'), [1, 10, 42, 43])
+
+    def test_bd_simplify(self):
+        # a square with nearly collinear vertices on its edges, about 10 m wide
+        coords = [(139.698, 35.5338), (139.69805, 35.5338000001), (139.6981, 35.5338),
+                  (139.6981, 35.53389), (139.69805, 35.5338900001), (139.698, 35.53389)]
+        buildings = pybdshadow.bd_preprocess(gpd.GeoDataFrame(
+            {'height': [10]}, geometry=[Polygon(coords)]))
+        simplified, report = pybdshadow.bd_simplify(buildings, 0.5, return_report=True)
+        assert report['walls_removed'] == 2
+        assert simplified.is_valid.all()
+        assert simplified.contains(buildings.buffer(-1e-9)).all()
+
+    def test_simplify_without_building(self):
+        # 20 m squares with 0.1 m steps on every facade, in UTM
+        def jagged(x0, y0):
+            south = [(x0+i, y0+0.1*(i % 2)) for i in range(20)]
+            east = [(x0+20-0.1*(i % 2), y0+i) for i in range(20)]
+            north = [(x0+20-i, y0+20-0.1*(i % 2)) for i in range(20)]
+            west = [(x0+0.1*(i % 2), y0+20-i) for i in range(20)]
+            return Polygon(south+east+north+west)
+        buildings = pybdshadow.bd_preprocess(gpd.GeoDataFrame(
+            {'height': [30, 20, 10]},
+            geometry=[jagged(383000, 3932000), jagged(383040, 3932000), jagged(383000, 3932040)],
+            crs='epsg:32654'))
+        prepared = pybdshadow.prepare_buildings(buildings, simplify_tolerance=0.3)
+        outlines = shapely.union_all(prepared.projection.inverse_geometry(prepared.footprints))
+        date = pd.to_datetime('2015-01-01 02:45:33.959797119')
+        for roof in [False, True]:
+            shadows = pybdshadow.bdshadow_sunlight(prepared, date, roof=roof, include_building=False)
+            ground = shadows[shadows['type'] == 'ground'].union_all()
+            # no sliver left inside the simplified outlines, only the 1 mm cleanup grid
+            assert shapely.intersection(ground, outlines).area < 0.1
+
+    def test_bd_dissolve(self):
+        # three terraced houses and a detached one touching only at a corner
+        buildings = gpd.GeoDataFrame({
+            'height': [10, 10.2, 9.9, 10],
+            'geometry': [Polygon([(0, 0), (8, 0), (8, 10), (0, 10)]),
+                         Polygon([(8, 0), (16, 0), (16, 10), (8, 10)]),
+                         Polygon([(16, 0), (24, 0), (24, 10), (16, 10)]),
+                         Polygon([(24, 10), (30, 10), (30, 16), (24, 16)])]},
+            crs='epsg:32654')
+        buildings = pybdshadow.bd_preprocess(buildings)
+        dissolved, mapping = pybdshadow.bd_dissolve(buildings, height_bin=1)
+        assert len(dissolved) == 2
+        assert list(mapping['dissolved_id']) == [0, 0, 0, 1]
+        assert len(pybdshadow.prepare_buildings(dissolved).walls) == 8
@@ -1,39 +1,19 @@
 import pybdshadow
+import copy
+import pytest
 import pandas as pd
 import numpy as np
+import shapely
 import geopandas as gpd
-from shapely.geometry import Polygon
+from shapely.geometry import Polygon, box
 
 
 class Testsunlightshadow:
-    def test_bdshadow_sunlight(self):
-
-        buildings = gpd.GeoDataFrame({
-            'height': [42, 9],
-            'geometry': [
-                Polygon([(139.698311, 35.533796),
-                        (139.698311,
-                            35.533642),
-                        (139.699075,
-                            35.533637),
-                        (139.699079,
-                            35.53417),
-                        (139.698891,
-                            35.53417),
-                        (139.698888,
-                            35.533794),
-                        (139.698311, 35.533796)]),
-                Polygon([(139.69799, 35.534175),
-                        (139.697988, 35.53389),
-                        (139.698814, 35.533885),
-                        (139.698816, 35.534171),
-                        (139.69799, 35.534175)])]})
+    def test_bdshadow_sunlight(self, buildings):
         date = pd.to_datetime('2015-01-01 03:45:33.959797119')
 
-        buildings = pybdshadow.bd_preprocess(buildings)
-
         buildingshadow = pybdshadow.bdshadow_sunlight(
-            buildings, date, roof=True, include_building=False)
+            buildings, date, roof=True, include_building=False, cleanup='buffer')
 
         area = buildingshadow['geometry'].iloc[0]
         area = np.array(area.exterior.coords)
@@ -54,3 +34,228 @@ class Testsunlightshadow:
 
         pybdshadow.show_bdshadow(buildings=buildings,
                                  shadows=buildingshadow)
+
+    def test_bdshadow_sunlight_dates(self, buildings):
+        dates = pd.to_datetime(['2015-01-01 02:45:33', '2015-01-01 04:45:33', '2015-01-01 06:45:33'])
+
+        shadows = pybdshadow.bdshadow_sunlight(buildings, dates)
+        assert len(shadows) == 6
+        assert shadows['date'].dtype == dates.dtype
+        for date in dates:
+            single = pybdshadow.bdshadow_sunlight(buildings, date)
+            batch = shadows[shadows['date'] == date]
+            assert np.allclose(batch.area.values, single.area.values)
+
+        # 所有时刻的地面阴影一次计算，与逐个时刻的结果相同
+        for options in [{'include_building': False}, {'roof': True}, {'workers': 2}]:
+            shadows = pybdshadow.bdshadow_sunlight(buildings, dates, **options)
+            for date in dates:
+                single = pybdshadow.bdshadow_sunlight(buildings, date, **options)
+                batch = shadows[shadows['date'] == date].drop(columns='date')
+                assert list(batch['building_id']) == list(single['building_id'])
+                assert batch.geom_equals_exact(single, 1e-9).all()
+
+        prepared = pybdshadow.prepare_buildings(buildings)
+        sunPositions = pybdshadow.get_prepared_sun_positions(prepared, dates)
+        targets = np.array([0, 1, 0])
+        swept = pybdshadow.sweep_shadows_batch(prepared, targets, [42., 9., 20.], sunPositions)
+        assert swept.shape == (3, 3)
+        for i, (azimuth, altitude) in enumerate(sunPositions):
+            single = pybdshadow.sweep_shadows(
+                prepared, targets, [42., 9., 20.], {'azimuth': azimuth, 'altitude': altitude})
+            assert shapely.equals_exact(swept[i], single, 1e-9).all()
+
+    def test_calSunShadow_vector_batch(self):
+        shape = np.array([[[139.6983, 35.5336], [139.6990, 35.5336]],
+                          [[139.6990, 35.5336], [139.6990, 35.5341]],
+                          [[139.6990, 35.5341], [139.6983, 35.5336]]])
+        shapeHeight = np.array([42., 42., 9.])
+        sunPositions = np.array([[0.3, 0.4], [-0.8, 0.9], [2.1, 0.2]])
+
+        batch = pybdshadow.calSunShadow_vector_batch(shape, shapeHeight, sunPositions)
+        assert batch.shape == (3, 3, 5, 2)
+        for i, (azimuth, altitude) in enumerate(sunPositions):
+            single = pybdshadow.calSunShadow_vector(
+                shape, shapeHeight, {'azimuth': azimuth, 'altitude': altitude})
+            assert np.allclose(batch[i], single)
+        # each sun position casts the walls in its own direction
+        assert not np.allclose(batch[0], batch[1])
+
+    def test_sweep_shadows(self):
+        # 凹多边形与凸多边形，顺时针与逆时针
+        L = Polygon([(0, 0), (40, 0), (40, 20), (20, 20), (20, 40), (0, 40)])
+        U = Polygon([(0, 0), (50, 0), (50, 40), (35, 40), (35, 15), (15, 15), (15, 40), (0, 40)])
+        footprints = [L, L.reverse(), U, U.reverse(), box(0, 0, 30, 20), box(0, 0, 30, 20).reverse()]
+        buildings = gpd.GeoDataFrame({
+            'building_id': range(6),
+            'height': [30, 20, 25, 12, 18, 40],
+            'geometry': [shapely.affinity.translate(f, 500000+100*i, 3930000) for i, f in enumerate(footprints)]},
+            crs='EPSG:32654')
+        prepared = pybdshadow.prepare_buildings(buildings)
+        assert list(prepared.convex) == [False, False, False, False, True, True]
+        # 只用墙面阴影合并的路径
+        from_walls = copy.copy(prepared)
+        from_walls.convex = np.zeros(len(prepared), dtype=bool)
+
+        targets = np.arange(len(prepared))
+        for azimuth in np.linspace(-np.pi, np.pi, 9)[:-1]+0.1:
+            sunPosition = {'azimuth': azimuth, 'altitude': 0.6}
+            offset = np.array([np.sin(azimuth), np.cos(azimuth)])/np.tan(0.6)
+            truth = []
+            for footprint, h in zip(prepared.footprints, prepared.heights):
+                coords = np.asarray(footprint.exterior.coords)
+                quads = [Polygon([a, b, b+h*offset, a+h*offset]) for a, b in zip(coords[:-1], coords[1:])]
+                truth.append(shapely.union_all([footprint]+quads))
+            for shadows in [
+                    pybdshadow.sweep_shadows(prepared, targets, prepared.heights, sunPosition),
+                    pybdshadow.sweep_shadows(prepared, targets, prepared.heights, sunPosition, cull_walls=False),
+                    pybdshadow.sweep_shadows(from_walls, targets, prepared.heights, sunPosition),
+                    pybdshadow.sweep_shadows(from_walls, targets, prepared.heights, sunPosition, cull_walls=False)]:
+                assert (shapely.area(shapely.symmetric_difference(shadows, truth)) < 1e-6).all()
+
+        date = pd.to_datetime('2015-01-01 02:45:33')
+        culled = pybdshadow.bdshadow_sunlight(buildings, date, roof=True)
+        full = pybdshadow.bdshadow_sunlight(buildings, date, roof=True, cull_walls=False)
+        assert (culled.symmetric_difference(full, align=False).area < 1e-6).all()
+
+    def test_prepared_buildings(self, buildings):
+        prepared = pybdshadow.prepare_buildings(buildings)
+        assert len(prepared) == 2
+        assert list(prepared.wall_offsets) == [0, 6, 10]
+        date = pd.to_datetime('2015-01-01 02:45:33.959797119')
+        for roof in [False, True]:
+            shadows = pybdshadow.bdshadow_sunlight(prepared, date, roof=roof)
+            truth = pybdshadow.bdshadow_sunlight(buildings, date, roof=roof)
+            assert np.allclose(shadows.area.values, truth.area.values)
+
+        # prepared buildings are reused as is, conflicting parameters are rejected
+        assert pybdshadow.prepare_buildings(prepared) is prepared
+        assert pybdshadow.prepare_buildings(prepared, ground=0) is prepared
+        binned = pybdshadow.prepare_buildings(buildings, height_bin=1)
+        assert pybdshadow.prepare_buildings(binned, height_bin=1) is binned
+        with pytest.raises(ValueError):
+            pybdshadow.cal_sunshadows(prepared, height_bin=1)
+        with pytest.raises(ValueError):
+            pybdshadow.bdshadow_sunlight(prepared, date, ground=5)
+
+    def test_bdshadow_sunlight_workers(self):
+        # 4x4 blocks of alternating heights, so that roofs are shaded across chunks
+        buildings = gpd.GeoDataFrame({
+            'height': [9+30*((i+j) % 2) for i in range(4) for j in range(4)],
+            'geometry': [shapely.box(139.698+i*0.0003, 35.533+j*0.0003,
+                                     139.698+i*0.0003+0.0002, 35.533+j*0.0003+0.0002)
+                         for i in range(4) for j in range(4)]})
+        buildings = pybdshadow.bd_preprocess(buildings)
+        date = pd.to_datetime('2015-01-01 02:45:33.959797119')
+        for roof in [False, True]:
+            truth = pybdshadow.bdshadow_sunlight(buildings, date, roof=roof)
+            shadows = pybdshadow.bdshadow_sunlight(buildings, date, roof=roof, workers=2)
+            assert shadows.drop(columns='geometry').equals(truth.drop(columns='geometry'))
+            assert shapely.equals_exact(
+                np.asarray(shadows.geometry), np.asarray(truth.geometry), 0).all()
+        assert (truth['type'] == 'roof').any()
+
+    def test_roof_shadows(self):
+        # 4x4 blocks of four heights, some of them L-shaped
+        L = Polygon([(0, 0), (20, 0), (20, 10), (10, 10), (10, 20), (0, 20)])
+        buildings = gpd.GeoDataFrame({
+            'building_id': range(16),
+            'height': [9+12*((2*i+j) % 4) for i in range(4) for j in range(4)],
+            'geometry': [shapely.affinity.translate(L if (i+j) % 3 == 0 else box(0, 0, 20, 20),
+                                                    500000+30*i, 3930000+30*j)
+                         for i in range(4) for j in range(4)]},
+            crs='EPSG:32654')
+        prepared = pybdshadow.prepare_buildings(buildings)
+        footprints, heights = prepared.footprints, prepared.heights
+        dates = pd.to_datetime(['2015-01-01 00:30', '2015-01-01 02:45', '2015-01-01 06:00'])
+        sunPositions = pybdshadow.get_prepared_sun_positions(prepared, dates)
+
+        for date, (azimuth, altitude) in zip(dates, sunPositions):
+            offset = np.array([np.sin(azimuth), np.cos(azimuth)])/np.tan(altitude)
+
+            def sweep(o, length):
+                coords = np.asarray(footprints[o].exterior.coords)
+                quads = [Polygon([a, b, b+length*offset, a+length*offset])
+                         for a, b in zip(coords[:-1], coords[1:])]
+                return shapely.union_all([footprints[o]]+quads)
+
+            # brute force over all the pairs
+            pairs = set()
+            truth = {}
+            for r in range(len(prepared)):
+                shade = [sweep(o, heights[o]-heights[r]) for o in range(len(prepared))
+                         if heights[o] > heights[r]]
+                reached = [o for o, s in zip(np.flatnonzero(heights > heights[r]), shade)
+                           if s.intersects(footprints[r])]
+                pairs.update((r, o) for o in reached)
+                shade = shapely.intersection(footprints[r], shapely.union_all(shade)).difference(
+                    shapely.union_all(footprints[heights > heights[r]]))
+                if shade.area > 1e-6:
+                    truth[prepared.building_id[r]] = shade
+
+            roof, occluder = pybdshadow.shadow_reach_pairs(
+                prepared.tree, heights, {'azimuth': azimuth, 'altitude': altitude}, prepared.bounds)
+            assert pairs <= set(zip(roof, occluder))
+            assert len(pairs) > 0
+
+            shadows = pybdshadow.bdshadow_sunlight(prepared, date, roof=True, cleanup=None)
+            shadows = shadows[shadows['type'] == 'roof']
+            assert sorted(shadows['building_id']) == sorted(truth)
+            result = prepared.projection.forward_geometry(shadows['geometry'])
+            expected = [truth[i] for i in shadows['building_id']]
+            assert (shapely.area(shapely.symmetric_difference(result, expected)) < 1e-6).all()
+            assert np.allclose(shadows['height'], heights[shadows['building_id']])
+
+    def test_bdshadow_sunlight_metric_crs(self, buildings):
+        date = pd.to_datetime('2015-01-01 02:45:33.959797119')
+        # UTM and Web Mercator(scale factor 1.23 at this latitude)
+        for epsg in [32654, 3857]:
+            metric = pybdshadow.bd_preprocess(buildings.to_crs(epsg))
+            assert metric.crs.to_epsg() == epsg
+            for roof in [False, True]:
+                shadows = pybdshadow.bdshadow_sunlight(metric, date, roof=roof)
+                assert shadows.crs.to_epsg() == epsg
+                truth = pybdshadow.bdshadow_sunlight(buildings, date, roof=roof)
+                assert np.allclose(shadows.area.values,
+                                   truth.to_crs(epsg).area.values, rtol=1e-3)
+                # same shadow geometry as the longitude and latitude path
+                shadows = shadows.to_crs('epsg:32654')
+                truth = truth.to_crs('epsg:32654')
+                assert (shadows.symmetric_difference(truth, align=False).area.values <
+                        1e-3*truth.area.values+1e-6).all()
+        with pytest.raises(ValueError):
+            pybdshadow.bdshadow_sunlight(buildings.to_crs('epsg:2263'), date)
+
+    def test_bdshadow_sunlight_stats(self, buildings):
+        prepared = pybdshadow.prepare_buildings(buildings)
+        date = pd.to_datetime('2015-01-01 02:45:33.959797119')
+        stats = pybdshadow.bdshadow_sunlight_stats(prepared, date)
+        shadows = pybdshadow.bdshadow_sunlight(prepared, date)
+        area = prepared.projection.forward_geometry(shadows['geometry'])
+        area = np.array([geometry.area for geometry in area])
+        assert (stats['area_lower'].values <= area+1e-6).all()
+        assert (area <= stats['area_upper'].values+1e-6).all()
+        # the second building is convex, its area is exact
+        assert stats['error'].iloc[1] == 0
+        assert np.isclose(stats['area_lower'].iloc[1], area[1])
+
+        # the extent is that of the shadows, also in degrees
+        dates = pd.to_datetime(['2015-01-01 00:45:33', '2015-01-01 02:45:33', '2015-01-01 06:45:33'])
+        stats = pybdshadow.bdshadow_sunlight_stats(prepared, dates)
+        shadows = pybdshadow.bdshadow_sunlight(prepared, dates)
+        assert np.allclose(stats[['minx', 'miny', 'maxx', 'maxy']].values,
+                           shadows.bounds.values, rtol=0, atol=1e-12)
+
+    def test_bdshadow_sunlight_cleanup(self, buildings):
+        date = pd.to_datetime('2015-01-01 03:45:33.959797119')
+        truth = pybdshadow.bdshadow_sunlight(
+            buildings, date, roof=True, cleanup='buffer')
+        for cleanup in ['precision', 'make_valid', None]:
+            shadows = pybdshadow.bdshadow_sunlight(
+                buildings, date, roof=True, cleanup=cleanup)
+            assert shadows.is_valid.all()
+            assert np.allclose(shadows.area.values, truth.area.values, rtol=1e-3)
+        shadows = pybdshadow.bdshadow_sunlight(buildings, date, roof=True, grid_size=1e-7)
+        assert shadows.is_valid.all()
+        coords = shapely.get_coordinates(shadows.geometry.values)
+        assert np.allclose(coords, np.round(coords, 7), rtol=0, atol=1e-12)
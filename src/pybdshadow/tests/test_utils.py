@@ -0,0 +1,34 @@
+import numpy as np
+import shapely
+from shapely.geometry import Polygon, box
+from pybdshadow.utils import bd_to_walls, union_by_group
+
+
+class Testutils:
+    def test_bd_to_walls(self):
+        footprints = [box(0, 0, 2, 1),
+                      Polygon([(0, 0), (4, 0), (4, 2), (2, 2), (2, 4), (0, 4)]),
+                      Polygon([(0, 0), (9, 0), (9, 9), (0, 9)], [[(3, 3), (6, 3), (6, 6), (3, 6)]])]
+        walls, wall_index = bd_to_walls(np.array(footprints))
+        assert walls.shape == (14, 2, 2)
+        assert list(wall_index) == [0]*4+[1]*6+[2]*4
+        # each wall joins two consecutive vertices of the exterior ring
+        for i, footprint in enumerate(footprints):
+            coords = np.asarray(footprint.exterior.coords)
+            assert np.array_equal(walls[wall_index == i, 0], coords[:-1])
+            assert np.array_equal(walls[wall_index == i, 1], coords[1:])
+
+    def test_union_by_group(self):
+        # groups of 1, 2, 3 and 5 geometries, so that several size classes are padded
+        codes = np.array([7, 3, 7, 5, 5, 5, 9, 9, 9, 9, 9])
+        geometries = np.array([box(i, 0, i+1.5, 1) for i in range(len(codes))])
+        rng = np.random.default_rng(0)
+        order = rng.permutation(len(codes))
+        groups, unions = union_by_group(geometries[order], codes[order])
+        assert list(groups) == [3, 5, 7, 9]
+        for group, union in zip(groups, unions):
+            truth = shapely.union_all(geometries[codes == group])
+            assert shapely.equals(union, truth)
+
+        groups, unions = union_by_group(np.array([], dtype=object), np.array([], dtype=int))
+        assert len(groups) == 0 and len(unions) == 0
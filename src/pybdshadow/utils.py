@@ -30,11 +30,12 @@ OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
+from functools import lru_cache
 import numpy as np
 import shapely
 import geopandas as gpd
 import pandas as pd
-from pyproj import CRS,Transformer
+from pyproj import CRS,Geod,Transformer
 from shapely.geometry import Polygon
 
 def extrude_poly(poly,h):
@@ -42,12 +43,513 @@ def extrude_poly(poly,h):
     poly_coords = np.c_[poly_coords, np.ones(poly_coords.shape[0])*h]
     return Polygon(poly_coords)
 
+def bd_to_walls(geometry):
+    '''
+    Split building footprints into walls.
+
+    Parameters
+    ----------
+    geometry : GeoSeries or numpy.ndarray
+        Polygon footprints of the buildings.
+
+    Returns
+    -------
+    walls : numpy.ndarray
+        Wall coordinates. The shape of the array is (n,2,2), where n the number of walls, 2 is that each wall has two points, and the last dimension is for x and y.
+    wall_index : numpy.ndarray
+        Positional index of the building that each wall belongs to, shape = [n]
+    '''
+    rings = shapely.get_exterior_ring(np.asarray(geometry))
+    coords, index = shapely.get_coordinates(rings, return_index=True)
+    # consecutive vertices of the same ring form a wall
+    same_ring = index[:-1] == index[1:]
+    walls = np.stack([coords[:-1][same_ring], coords[1:][same_ring]], axis=1)
+    wall_index = index[:-1][same_ring]
+    return walls, wall_index
+
+def is_convex(geometry, rtol=1e-9):
+    '''
+    Check whether the building footprints are convex.
+
+    Parameters
+    ----------
+    geometry : GeoSeries or numpy.ndarray
+        Polygon footprints of the buildings.
+    rtol : float
+        Relative tolerance between the area of the footprint and the area of its convex hull.
+
+    Returns
+    -------
+    convex : numpy.ndarray
+        Whether each footprint is convex and has no holes.
+    '''
+    geometry = np.asarray(geometry)
+    area = shapely.area(geometry)
+    hull_area = shapely.area(shapely.convex_hull(geometry))
+    return (shapely.get_num_interior_rings(geometry) == 0) & \
+        (hull_area-area <= rtol*hull_area)
+
+def snap_to_grid(geometry, grid_size):
+    '''
+    Snap the coordinates of the geometries to a grid and remove the redundant vertices.
+
+    Parameters
+    ----------
+    geometry : GeoSeries or numpy.ndarray
+        Geometries.
+    grid_size : float
+        Size of the grid, in the unit of the coordinates, e.g. 0.01 for 1 cm in meters or 1e-7 in degrees.
+
+    Returns
+    -------
+    geometry : numpy.ndarray
+        Snapped geometries. The polygons stay valid, the ones collapsed by the snapping become empty.
+    '''
+    # set_precision 会去除重复点并保证结果有效，simplify(0) 再去除共线点
+    geometry = shapely.set_precision(np.asarray(geometry), grid_size)
+    return shapely.simplify(geometry, 0, preserve_topology=True)
+
+def wall_normals(walls, wall_index):
+    '''
+    Calculate the outward normal vectors of the walls.
+    Both ring orientations are supported(see `make_clockwise`), the orientation of each ring
+    is obtained from the sign of its area.
+
+    Parameters
+    ----------
+    walls : numpy.ndarray
+        Wall coordinates, shape = [n,2,2]
+    wall_index : numpy.ndarray
+        Positional index of the building that each wall belongs to, shape = [n]
+
+    Returns
+    -------
+    normals : numpy.ndarray
+        Outward normal of each wall, the length of the normal is the length of the wall. shape = [n,2]
+    '''
+    cross = walls[:, 0, 0]*walls[:, 1, 1]-walls[:, 1, 0]*walls[:, 0, 1]
+    signed_area = np.bincount(wall_index, weights=cross)
+    # counterclockwise rings have positive area and the outside on the right of each wall
+    orientation = np.where(signed_area[wall_index] >= 0, 1, -1).reshape((-1, 1))
+    vector = walls[:, 1, :]-walls[:, 0, :]
+    normals = np.column_stack([vector[:, 1], -vector[:, 0]])*orientation
+    return normals
+
+def union_by_group(geometries, codes):
+    '''
+    Union the geometries that share the same group code.
+
+    Groups of similar size are padded into one matrix and unioned together,
+    so that the union runs in bulk instead of building a geometry list per group.
+
+    Parameters
+    ----------
+    geometries : numpy.ndarray
+        Geometries to be unioned, shape = [n]
+    codes : numpy.ndarray
+        Integer group code of each geometry, shape = [n]
+
+    Returns
+    -------
+    groups : numpy.ndarray
+        Sorted unique group codes, shape = [m]
+    unions : numpy.ndarray
+        Union of the geometries in each group, shape = [m]
+    '''
+    geometries = np.asarray(geometries, dtype=object)
+    codes = np.asarray(codes)
+    groups, inverse, counts = np.unique(
+        codes, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    unions = np.empty(len(groups), dtype=object)
+    if len(groups) == 0:
+        return groups, unions
+
+    # position of each geometry within its group
+    order = np.argsort(inverse, kind='stable')
+    starts = np.cumsum(counts) - counts
+    rank = np.empty(len(order), dtype=int)
+    rank[order] = np.arange(len(order)) - np.repeat(starts, counts)
+
+    # groups are bucketed by size so that the padding at most doubles the matrix
+    size_class = np.ceil(np.log2(counts)).astype(int)
+    row = np.full(len(groups), -1)
+    for c in np.unique(size_class):
+        selected = np.flatnonzero(size_class == c)
+        row[:] = -1
+        row[selected] = np.arange(len(selected))
+        members = row[inverse] >= 0
+        matrix = np.full((len(selected), counts[selected].max()), None, dtype=object)
+        matrix[row[inverse][members], rank[members]] = geometries[members]
+        unions[selected] = shapely.union_all(matrix, axis=1)
+    return groups, unions
+
+def groupby_union(gdf, by):
+    '''
+    Union the geometries of a GeoDataFrame by the given columns,
+    the same as `gdf.groupby(by)['geometry'].apply(union).reset_index()`.
+
+    Parameters
+    ----------
+    gdf : GeoDataFrame
+        Geometries to be unioned.
+    by : str or list
+        Column names to group by.
+
+    Returns
+    -------
+    result : GeoDataFrame
+        The group columns and the unioned geometry of each group.
+    '''
+    by = [by] if isinstance(by, str) else list(by)
+    grouped = gdf.groupby(by)
+    codes = grouped.ngroup().values
+    keep = codes >= 0
+    groups, unions = union_by_group(gdf['geometry'].values[keep], codes[keep])
+    result = grouped.size().index.to_frame(index=False).iloc[groups]
+    result = gpd.GeoDataFrame(result.reset_index(drop=True),
+                              geometry=list(unions), crs=gdf.crs)
+    return result
+
 def make_clockwise(polygon):
     if polygon.exterior.is_ccw:
         return polygon
     else:
         return Polygon(list(polygon.exterior.coords)[::-1])
 
+@lru_cache(maxsize=64)
+def get_aeqd_transformers(center_lon, center_lat):
+    '''
+    Get the transformers between WGS84 and the azimuthal equidistant projection centred on the given point.
+    The transformers are cached, so that repeated projections around the same center do not rebuild them.
+
+    Parameters
+    ----------
+    center_lon, center_lat : float
+        Center of the azimuthal equidistant projection in degrees.
+
+    Returns
+    -------
+    forward : pyproj.Transformer
+        Transformer from WGS84 to the azimuthal equidistant projection.
+    inverse : pyproj.Transformer
+        Transformer from the azimuthal equidistant projection to WGS84.
+    '''
+    epsg = CRS.from_proj4("+proj=aeqd +lat_0="+str(center_lat) +
+                          " +lon_0="+str(center_lon)+" +datum=WGS84")
+    forward = Transformer.from_crs("EPSG:4326", epsg, always_xy=True)
+    inverse = Transformer.from_crs(epsg, "EPSG:4326", always_xy=True)
+    return forward, inverse
+
+class LocalProjection:
+    '''
+    Local azimuthal equidistant projection of a dataset.
+
+    The coordinates of a dataset are projected once into metres around its center,
+    kept in metres during the calculation and converted back to longitude and latitude only at output.
+
+    Parameters
+    ----------
+    center_lon, center_lat : float
+        Center of the azimuthal equidistant projection in degrees.
+    '''
+    def __init__(self, center_lon, center_lat):
+        self.center_lon = float(center_lon)
+        self.center_lat = float(center_lat)
+        self._forward, self._inverse = get_aeqd_transformers(
+            self.center_lon, self.center_lat)
+
+    @classmethod
+    def from_geometry(cls, geometry):
+        '''
+        Create the projection centred on the mean bounds of the geometries.
+        '''
+        lon1, lat1, lon2, lat2 = shapely.bounds(np.asarray(geometry)).mean(axis=0)
+        return cls((lon1+lon2)/2, (lat1+lat2)/2)
+
+    def forward(self, lonlat):
+        '''
+        Project coordinates of shape (...,2) from longitude and latitude to metres.
+        '''
+        lonlat = np.asarray(lonlat, dtype=float)
+        x, y = self._forward.transform(lonlat[..., 0], lonlat[..., 1])
+        return np.stack([x, y], axis=-1)
+
+    def inverse(self, proj_coords):
+        '''
+        Convert coordinates of shape (...,2) from metres to longitude and latitude.
+        '''
+        proj_coords = np.asarray(proj_coords, dtype=float)
+        lon, lat = self._inverse.transform(proj_coords[..., 0], proj_coords[..., 1])
+        return np.stack([lon, lat], axis=-1)
+
+    def forward_geometry(self, geometry):
+        '''
+        Project geometries from longitude and latitude to metres.
+        '''
+        return shapely.transform(np.asarray(geometry), self.forward)
+
+    def inverse_geometry(self, geometry):
+        '''
+        Convert geometries from metres to longitude and latitude.
+        '''
+        return shapely.transform(np.asarray(geometry), self.inverse)
+
+class MetricProjection:
+    '''
+    Projection for data already in a projected coordinate system in metres.
+
+    It has the same interface as `LocalProjection`, so the shadows are calculated directly in
+    the coordinates of the data without a round trip through longitude and latitude.
+    The coordinates are only mapped by the local linear approximation of the coordinate system
+    at the center, measured with geodesics, so that they are true metres towards east and north
+    like the building heights. This corrects the scale factor(e.g. 1/cos(latitude) for Web Mercator),
+    the grid convergence and the distortion of the non-conformal coordinate systems at the center.
+
+    Parameters
+    ----------
+    crs : pyproj.CRS or str
+        Projected coordinate system of the data, with units in metres.
+    center_x, center_y : float
+        Center of the data in the projected coordinate system.
+    '''
+    def __init__(self, crs, center_x, center_y):
+        self.crs = CRS.from_user_input(crs)
+        self.center_x = float(center_x)
+        self.center_y = float(center_y)
+        to_lonlat = Transformer.from_crs(self.crs, "EPSG:4326", always_xy=True)
+        self.center_lon, self.center_lat = to_lonlat.transform(self.center_x, self.center_y)
+        # 中心处东、北方向各10米在坐标系中的位移
+        distance = 10
+        lon, lat, _ = Geod(ellps='WGS84').fwd(
+            [self.center_lon]*4, [self.center_lat]*4, [90, 270, 0, 180], [distance]*4)
+        from_lonlat = Transformer.from_crs("EPSG:4326", self.crs, always_xy=True)
+        x, y = from_lonlat.transform(lon, lat)
+        self.jacobian = np.array([[x[0]-x[1], x[2]-x[3]],
+                                  [y[0]-y[1], y[2]-y[3]]])/(2*distance)
+        self._inverse_jacobian = np.linalg.inv(self.jacobian)
+        # 平均比例因子
+        self.scale = float(np.sqrt(abs(np.linalg.det(self.jacobian))))
+
+    @classmethod
+    def from_geometry(cls, geometry, crs):
+        '''
+        Create the projection centred on the mean bounds of the geometries.
+        '''
+        x1, y1, x2, y2 = shapely.bounds(np.asarray(geometry)).mean(axis=0)
+        return cls(crs, (x1+x2)/2, (y1+y2)/2)
+
+    def forward(self, coords):
+        '''
+        Map coordinates of shape (...,2) from the coordinate system to true metres.
+        '''
+        center = np.array([self.center_x, self.center_y])
+        return center+(np.asarray(coords, dtype=float)-center)@self._inverse_jacobian.T
+
+    def inverse(self, proj_coords):
+        '''
+        Map coordinates of shape (...,2) from true metres back to the coordinate system.
+        '''
+        center = np.array([self.center_x, self.center_y])
+        return center+(np.asarray(proj_coords, dtype=float)-center)@self.jacobian.T
+
+    def forward_geometry(self, geometry):
+        '''
+        Map geometries from the coordinate system to true metres.
+        '''
+        return shapely.transform(np.asarray(geometry), self.forward)
+
+    def inverse_geometry(self, geometry):
+        '''
+        Map geometries from true metres back to the coordinate system.
+        '''
+        return shapely.transform(np.asarray(geometry), self.inverse)
+
+
+def is_metric_crs(crs):
+    '''
+    Check whether a coordinate system is projected with units in metres,
+    so that the data can be processed in its own coordinates.
+    '''
+    if crs is None:
+        return False
+    crs = CRS.from_user_input(crs)
+    return crs.is_projected and all(
+        axis.unit_name in ('metre', 'meter') for axis in crs.axis_info)
+
+
+def connected_components(n, a, b):
+    '''
+    Label the connected components of a graph with a union-find.
+
+    Parameters
+    ----------
+    n : int
+        Number of nodes.
+    a, b : numpy.ndarray
+        The two nodes of each edge.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Component of each node, numbered from 0 in the order of their first node.
+    '''
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    for i, j in zip(a.tolist(), b.tolist()):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    roots = np.array([find(i) for i in range(n)], dtype=int)
+    _, labels = np.unique(roots, return_inverse=True)
+    return labels
+
+
+def spatial_chunks(geometry, n_chunks):
+    '''
+    Split the geometries into spatially coherent chunks.
+
+    The geometries are ordered along the Hilbert curve of their bounding box centers
+    and cut into chunks of similar size, so that each chunk covers a compact area.
+
+    Parameters
+    ----------
+    geometry : numpy.ndarray
+        Geometries to be split, shape = [n]
+    n_chunks : int
+        Number of chunks, at most n.
+
+    Returns
+    -------
+    chunks : list
+        Sorted positional index of the geometries in each chunk.
+    '''
+    geometry = np.asarray(geometry)
+    n_chunks = max(1, min(int(n_chunks), len(geometry)))
+    if len(geometry) <= 1:
+        return [np.arange(len(geometry))]
+    distance = gpd.GeoSeries(geometry).hilbert_distance().values
+    order = np.argsort(distance, kind='stable')
+    return [np.sort(chunk) for chunk in np.array_split(order, n_chunks)]
+
+
+def get_projection(geometry, crs):
+    '''
+    Get the projection used to calculate the shadows of the geometries in meters.
+
+    Geometries in a projected coordinate system in metres are used in their own coordinates(`MetricProjection`),
+    the others are projected to a local azimuthal equidistant projection centred on them(`LocalProjection`).
+    Projected coordinate systems in other units(e.g. feet) raise a ValueError.
+    '''
+    geometry = np.asarray(geometry)
+    if (crs is not None) and CRS.from_user_input(crs).is_projected and not is_metric_crs(crs):
+        raise ValueError(
+            'The unit of the projected coordinate system should be metre, '
+            'reproject the buildings to a metric coordinate system or to WGS84.')
+    if is_metric_crs(crs):
+        if len(geometry) > 0:
+            return MetricProjection.from_geometry(geometry, crs)
+        return MetricProjection(crs, 0, 0)
+    if len(geometry) > 0:
+        return LocalProjection.from_geometry(geometry)
+    return LocalProjection(0, 0)
+
+
+def rasterize_polygons(geometry, transform, shape):
+    '''
+    Rasterize polygons with scanlines, a cell is covered when its center is inside a polygon.
+
+    Each ring edge is intersected with the rows whose center lies in its vertical range,
+    the crossings of each polygon and row are sorted and paired into spans(even-odd rule, so
+    the holes are left out), and the spans are accumulated with a difference array.
+    Overlapping polygons do not need to be unioned beforehand.
+
+    Parameters
+    ----------
+    geometry : numpy.ndarray
+        Polygons or multipolygons, other geometry types are ignored.
+    transform : tuple
+        GDAL geotransform of the raster, `(x_min, cell width, 0, y_max, 0, -cell height)`.
+    shape : tuple
+        Number of rows and columns of the raster.
+
+    Returns
+    -------
+    covered : numpy.ndarray
+        Whether each cell is covered by the polygons, shape = shape
+    '''
+    x0, dx, _, y0, _, dy = transform
+    nrows, ncols = shape
+    polygons = shapely.get_parts(np.asarray(geometry, dtype=object))
+    polygons = polygons[shapely.get_type_id(polygons) == 3]
+    rings, ring_polygon = shapely.get_rings(polygons, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    edge = coord_ring[:-1] == coord_ring[1:]
+    x1, y1 = coords[:-1][edge].T
+    x2, y2 = coords[1:][edge].T
+    polygon = ring_polygon[coord_ring[:-1][edge]]
+
+    # 每条边穿过的行：行中心y在[min(y1,y2), max(y1,y2))内
+    u1, u2 = (y1-y0)/dy-0.5, (y2-y0)/dy-0.5
+    first = np.clip(np.floor(np.minimum(u1, u2)).astype(int)+1, 0, nrows)
+    last = np.clip(np.floor(np.maximum(u1, u2)).astype(int), -1, nrows-1)
+    counts = np.maximum(last-first+1, 0)
+    pair_edge = np.repeat(np.arange(len(counts)), counts)
+    row = np.repeat(first, counts)+np.arange(counts.sum())-np.repeat(np.cumsum(counts)-counts, counts)
+    y = y0+(row+0.5)*dy
+    x = x1[pair_edge]+(y-y1[pair_edge])*(x2-x1)[pair_edge]/(y2-y1)[pair_edge]
+
+    # 同一多边形同一行的交点排序后两两配对
+    order = np.lexsort([x, row, polygon[pair_edge]])
+    x, row = x[order], row[order]
+    start = np.clip(np.ceil((x[0::2]-x0)/dx-0.5).astype(int), 0, ncols)
+    end = np.clip(np.ceil((x[1::2]-x0)/dx-0.5).astype(int), 0, ncols)
+    row = row[0::2]
+    diff = np.zeros((nrows, ncols+1), dtype=np.int32)
+    np.add.at(diff, (row, start), 1)
+    np.add.at(diff, (row, end), -1)
+    return np.cumsum(diff[:, :-1], axis=1) > 0
+
+
+def simplify_footprints(geometry, tolerance):
+    '''
+    Simplify building footprints without shrinking them.
+
+    Each footprint is expanded by half of `tolerance` with mitred corners and then simplified with the
+    other half, so the simplified outline lies outside the original one and within about `tolerance` of it.
+    If the result does not contain the original footprint, is invalid or has more vertices,
+    the original footprint is kept.
+
+    Parameters
+    ----------
+    geometry : numpy.ndarray
+        Polygon footprints in meters.
+    tolerance : float
+        Simplification tolerance(meter).
+
+    Returns
+    -------
+    simplified : numpy.ndarray
+        Simplified footprints.
+    fallback : numpy.ndarray
+        Whether the original footprint is kept.
+    '''
+    geometry = np.asarray(geometry)
+    simplified = shapely.simplify(
+        shapely.buffer(geometry, tolerance/2, join_style='mitre'), tolerance/2, preserve_topology=True)
+    fallback = ~(shapely.is_valid(simplified) &
+                 (shapely.get_type_id(simplified) == 3) &
+                 shapely.contains(simplified, geometry) &
+                 (shapely.get_num_coordinates(simplified) < shapely.get_num_coordinates(geometry)))
+    simplified[fallback] = geometry[fallback]
+    return simplified, fallback
+
+
 def lonlat2aeqd(lonlat, center_lon, center_lat):
     '''
     Convert longitude and latitude to azimuthal equidistant projection coordinates.
@@ -74,9 +576,7 @@ def lonlat2aeqd(lonlat, center_lon, center_lat):
            [[-48243.5939812 , -55322.02388971],
             [ 47752.57582735,  55538.86412435]]])
     '''
-    epsg = CRS.from_proj4("+proj=aeqd +lat_0="+str(center_lat) +
-                          " +lon_0="+str(center_lon)+" +datum=WGS84")
-    transformer = Transformer.from_crs("EPSG:4326", epsg, always_xy=True)
+    transformer, _ = get_aeqd_transformers(float(center_lon), float(center_lat))
     proj_coords = transformer.transform(lonlat[:, :, 0], lonlat[:, :, 1])
     proj_coords = np.array(proj_coords).transpose([1, 2, 0])
     return proj_coords
@@ -89,9 +589,7 @@ def aeqd2lonlat_3d(proj_coords, meanlon, meanlat):
         xy_coords.shape[:2])
 
     # 定义转换器
-    epsg = CRS.from_proj4("+proj=aeqd +lat_0=" + str(meanlat) +
-                          " +lon_0=" + str(meanlon) + " +datum=WGS84")
-    transformer = Transformer.from_crs(epsg, "EPSG:4326", always_xy=True)
+    _, transformer = get_aeqd_transformers(float(meanlon), float(meanlat))
 
     # 转换 xy 坐标
     lon, lat = transformer.transform(xy_coords[:, :, 0], xy_coords[:, :, 1])
@@ -135,8 +633,7 @@ def aeqd2lonlat(proj_coords,meanlon,meanlat):
             [121.,  31.]]])
     '''
 
-    epsg = CRS.from_proj4("+proj=aeqd +lat_0="+str(meanlat)+" +lon_0="+str(meanlon)+" +datum=WGS84")
-    transformer = Transformer.from_crs( epsg,"EPSG:4326",always_xy = True)
+    _, transformer = get_aeqd_transformers(float(meanlon), float(meanlat))
     lonlat = transformer.transform(proj_coords[:,:,0], proj_coords[:,:,1])
     lonlat = np.array(lonlat).transpose([1,2,0])
     return lonlat